@@ -1,9 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, AsyncIterator, Optional
 import logging
 from datetime import datetime
 
 from models import ActionResult
-from actions.notion import get_notion_manager
+from actions.notion import NotionCredentials, NotionManager, get_notion_pool
+from resilience import Deadline, DeadlineExceeded, CircuitOpenError
 
 logger = logging.getLogger(__name__)
 
@@ -12,46 +13,104 @@ class ActionRunner:
     """Exécute les actions définies dans le JSON"""
     
     def __init__(self):
-        self.notion_manager = get_notion_manager()
+        self.notion_pool = get_notion_pool()
     
-    async def execute_tasks(self, tasks_json: Dict[str, Any]) -> List[ActionResult]:
+    async def execute_tasks(
+        self,
+        tasks_json: Dict[str, Any],
+        credentials: Optional[NotionCredentials] = None,
+        deadline: Optional[Deadline] = None
+    ) -> List[ActionResult]:
         """
         Exécute toutes les tâches du JSON
         
         Args:
             tasks_json: Dict contenant la clé "tasks" avec la liste des actions
+            credentials: Identifiants Notion du tenant (défaut : environnement)
+            deadline: Échéance de la requête (DeadlineExceeded une fois dépassée)
             
         Returns:
-            Liste des résultats d'exécution
+            Liste des résultats d'exécution (voir iter_tasks en cas d'interruption)
+            
+        Raises:
+            CircuitOpenError: si Notion est coupé avant toute action réussie
+            DeadlineExceeded: si le budget est épuisé avant toute action réussie
+        """
+        return [result async for result in self.iter_tasks(tasks_json, credentials, deadline)]
+    
+    async def iter_tasks(
+        self,
+        tasks_json: Dict[str, Any],
+        credentials: Optional[NotionCredentials] = None,
+        deadline: Optional[Deadline] = None
+    ) -> AsyncIterator[ActionResult]:
+        """
+        Exécute les tâches une par une et produit chaque résultat dès qu'il est prêt
+        
+        Args:
+            tasks_json: Dict contenant la clé "tasks" avec la liste des actions
+            credentials: Identifiants Notion du tenant (défaut : environnement)
+            deadline: Échéance de la requête (DeadlineExceeded une fois dépassée)
+            
+        Yields:
+            ActionResult de chaque action, dans l'ordre. Si Notion devient
+            indisponible (ou le budget s'épuise) après au moins une action
+            réussie, l'exécution s'arrête et l'action en cours ainsi que les
+            suivantes sont produites en erreur.
+            
+        Raises:
+            CircuitOpenError: si Notion est coupé avant toute action réussie
+            DeadlineExceeded: si le budget est épuisé avant toute action réussie
         """
         tasks = tasks_json.get("tasks", [])
-        results = []
         
         logger.info(f"Executing {len(tasks)} task(s)")
         
+        succeeded = False
         for i, task in enumerate(tasks):
             logger.info(f"Task {i+1}/{len(tasks)}: {task.get('action')} on {task.get('app')}")
             
             try:
-                result = await self._execute_single_task(task)
-                results.append(result)
+                result = await self._execute_single_task(task, credentials, deadline)
+            except (CircuitOpenError, DeadlineExceeded) as e:
+                if not succeeded:
+                    # Rien n'a été créé : la requête échoue (503/504) et peut être rejouée
+                    raise
+                # Des actions ont déjà abouti : on les conserve, le reste est abandonné
+                logger.warning(f"Stopping after task {i}/{len(tasks)}: {e}")
+                for skipped in tasks[i:]:
+                    yield ActionResult(
+                        action=skipped.get("action", "unknown"),
+                        app=skipped.get("app", "unknown"),
+                        status="error",
+                        message=f"Non exécutée: {str(e)}"
+                    )
+                return
             except Exception as e:
                 logger.error(f"Error executing task {i+1}: {e}")
-                results.append(ActionResult(
+                result = ActionResult(
                     action=task.get("action", "unknown"),
                     app=task.get("app", "unknown"),
                     status="error",
                     message=f"Erreur: {str(e)}"
-                ))
-        
-        return results
+                )
+            
+            succeeded = succeeded or result.status == "success"
+            yield result
     
-    async def _execute_single_task(self, task: Dict[str, Any]) -> ActionResult:
+    async def _execute_single_task(
+        self,
+        task: Dict[str, Any],
+        credentials: Optional[NotionCredentials] = None,
+        deadline: Optional[Deadline] = None
+    ) -> ActionResult:
         """
         Exécute une seule tâche
         
         Args:
             task: Dict représentant l'action à effectuer
+            credentials: Identifiants Notion du tenant
+            deadline: Échéance de la requête
             
         Returns:
             ActionResult avec le résultat de l'exécution
@@ -61,7 +120,7 @@ class ActionRunner:
         
         # Router vers le bon gestionnaire - Tout utilise Notion maintenant
         if app in ["notion", "notion_calendar", "calendar", "tasks"]:
-            return await self._handle_notion_action(action, task)
+            return await self._handle_notion_action(action, task, credentials, deadline)
         else:
             return ActionResult(
                 action=action,
@@ -72,51 +131,35 @@ class ActionRunner:
     
 
     
-    async def _handle_notion_action(self, action: str, task: Dict[str, Any]) -> ActionResult:
+    async def _handle_notion_action(
+        self,
+        action: str,
+        task: Dict[str, Any],
+        credentials: Optional[NotionCredentials] = None,
+        deadline: Optional[Deadline] = None
+    ) -> ActionResult:
         """Gère toutes les actions Notion (pages, tâches, événements)"""
         try:
-            if action == "create_page":
-                result = await self.notion_manager.create_page(
-                    title=task.get("title"),
-                    content=task.get("content"),
-                    database_id=task.get("database_id")
-                )
-            elif action == "create_task":
-                result = await self.notion_manager.create_task(
-                    title=task.get("title"),
-                    due_date=task.get("due_date"),
-                    priority=task.get("priority", "medium"),
-                    description=task.get("description")
-                )
-            elif action == "create_event":
-                # Créer un événement comme une tâche avec date/heure
-                title = task.get("title")
-                date = task.get("date")
-                time = task.get("time", "00:00")
-                
-                # Combiner date et heure au format ISO
-                datetime_str = f"{date}T{time}:00"
-                
-                result = await self.notion_manager.create_task(
-                    title=f"📅 {title}",
-                    due_date=datetime_str,
-                    priority="medium",
-                    description=f"Événement le {date} à {time}\n{task.get('description', '')}"
-                )
-            else:
-                result = {
-                    "status": "error",
-                    "message": f"Action inconnue: {action}"
-                }
+            if deadline:
+                deadline.budget()
+            
+            async with self.notion_pool.lease(credentials) as notion_manager:
+                result = await self._run_notion_action(notion_manager, action, task, deadline)
             
             return ActionResult(
                 action=action,
                 app="notion",
                 status=result.get("status"),
                 message=result.get("message"),
-                details=result
+                # statut et message sont déjà portés par ActionResult
+                details={
+                    key: value for key, value in result.items()
+                    if key not in ("status", "message")
+                } or None
             )
             
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
             logger.error(f"Notion action error: {e}")
             return ActionResult(
@@ -126,6 +169,83 @@ class ActionRunner:
                 message=f"Erreur: {str(e)}"
             )
     
+    async def _run_notion_action(
+        self,
+        notion_manager: NotionManager,
+        action: str,
+        task: Dict[str, Any],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[str, Any]:
+        """Appelle la méthode du NotionManager correspondant à l'action"""
+        if action == "create_page":
+            result = await notion_manager.create_page(
+                title=task.get("title"),
+                content=task.get("content"),
+                database_id=task.get("database_id"),
+                deadline=deadline
+            )
+        elif action == "create_task":
+            result = await notion_manager.create_task(
+                title=task.get("title"),
+                due_date=task.get("due_date"),
+                priority=task.get("priority", "medium"),
+                description=task.get("description"),
+                deadline=deadline
+            )
+        elif action == "create_event":
+            # Créer un événement comme une tâche avec date/heure
+            title = task.get("title")
+            date = task.get("date")
+            time = task.get("time", "00:00")
+            
+            # Combiner date et heure au format ISO
+            datetime_str = f"{date}T{time}:00"
+            
+            result = await notion_manager.create_task(
+                title=f"📅 {title}",
+                due_date=datetime_str,
+                priority="medium",
+                description=f"Événement le {date} à {time}\n{task.get('description', '')}",
+                deadline=deadline
+            )
+        elif action == "update_event":
+            # page_id, entity_action, et la date ou l'heure manquante, sont résolus
+            # depuis la session (référence #n)
+            page_id = task.get("page_id")
+            date = task.get("date")
+            time = task.get("time")
+            
+            if not page_id:
+                return {
+                    "status": "error",
+                    "message": "Événement à modifier introuvable"
+                }
+            if time and not date:
+                # Heure seule sur une entité sans date : impossible de construire l'échéance
+                return {
+                    "status": "error",
+                    "message": "Date de l'événement inconnue : précisez la date"
+                }
+            
+            title = task.get("title")
+            if title and task.get("entity_action") == "create_event":
+                # Même préfixe qu'à la création ; une page ou une tâche garde son titre tel quel
+                title = f"📅 {title}"
+            
+            result = await notion_manager.update_task(
+                page_id=page_id,
+                title=title,
+                due_date=f"{date}T{time}:00" if date and time else date,
+                deadline=deadline
+            )
+        else:
+            result = {
+                "status": "error",
+                "message": f"Action inconnue: {action}"
+            }
+        
+        return result
+    
 
 
 
@@ -1,19 +1,110 @@
 import os
-from typing import Dict, Any, Optional
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional, AsyncIterator
 from datetime import datetime
 import logging
 
+from resilience import Deadline, DeadlineExceeded, CircuitOpenError, get_circuit_breaker
+
 logger = logging.getLogger(__name__)
 
 
+# Taille maximale du pool de clients et durée d'inactivité avant fermeture (secondes)
+NOTION_POOL_SIZE = int(os.getenv("NOTION_POOL_SIZE", "32"))
+NOTION_POOL_IDLE_TIMEOUT = float(os.getenv("NOTION_POOL_IDLE_TIMEOUT", "300"))
+
+# Limite de débit par intégration Notion (~3 requêtes/s en moyenne)
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_RATE_BURST = int(os.getenv("NOTION_RATE_BURST", "3"))
+
+# Timeout maximal d'un appel Notion (réduit au budget restant de la requête)
+NOTION_TIMEOUT = float(os.getenv("NOTION_TIMEOUT", "20"))
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    """
+    Une erreur 4xx vient de la requête ou du tenant, pas de Notion
+
+    Le circuit breaker est partagé par tous les tenants : un 429 (limite de
+    débit propre à une intégration) ne doit pas couper Notion pour les autres.
+    """
+    status = getattr(exc, "status", None)
+    if isinstance(status, int):
+        return status >= 500
+    return True
+
+
+@dataclass(frozen=True)
+class NotionCredentials:
+    """Identifiants Notion d'un étudiant (tenant)"""
+    api_key: str = field(repr=False)
+    database_id: Optional[str] = None
+    
+    @classmethod
+    def from_env(cls) -> "NotionCredentials":
+        """Identifiants par défaut (variables d'environnement)"""
+        return cls(
+            api_key=os.getenv("NOTION_API_KEY") or "",
+            database_id=os.getenv("NOTION_DATABASE_ID")
+        )
+    
+    @property
+    def tenant_id(self) -> str:
+        """Identifiant court du tenant, utilisable dans les logs"""
+        return hashlib.sha256(self.api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class TokenBucket:
+    """Limiteur de débit asynchrone (token bucket)"""
+    
+    def __init__(self, rate: float = NOTION_RATE_LIMIT, capacity: int = NOTION_RATE_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def is_idle(self) -> bool:
+        """Vrai si le seau est plein : il équivaut alors à un seau neuf"""
+        tokens = self._tokens + (time.monotonic() - self._updated) * self.rate
+        return tokens >= self.capacity and not self._lock.locked()
+    
+    async def acquire(self):
+        """Attend qu'un jeton soit disponible puis le consomme"""
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1.0
+                self._updated = time.monotonic()
+            
+            self._tokens -= 1
+
+
 class NotionManager:
     """Gestionnaire pour Notion API"""
     
-    def __init__(self):
-        self.api_key = os.getenv("NOTION_API_KEY")
-        self.database_id = os.getenv("NOTION_DATABASE_ID")
+    def __init__(
+        self,
+        credentials: Optional[NotionCredentials] = None,
+        rate_limiter: Optional[TokenBucket] = None
+    ):
+        credentials = credentials or NotionCredentials.from_env()
+        self.api_key = credentials.api_key
+        self.database_id = credentials.database_id
         self.client = None
         self._client_initialized = False
+        # Limite de débit de l'intégration (partagée par le pool entre clients du même token)
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.circuit_breaker = get_circuit_breaker("notion", is_failure=_is_upstream_failure)
         
         self._initialize_client()
     
@@ -53,12 +144,51 @@ class NotionManager:
             finally:
                 self._client_initialized = False
     
+    async def _pages_call(
+        self,
+        operation: str,
+        payload: Dict[str, Any],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[str, Any]:
+        """
+        Appelle pages.create / pages.update (limite de débit, circuit breaker et timeout)
+        
+        L'attente de la limite de débit est bornée par l'échéance, et le timeout
+        de l'appel est calculé sur le budget restant après cette attente. Seul un
+        timeout égal à NOTION_TIMEOUT compte comme une panne de Notion.
+        """
+        method = getattr(self.client.pages, operation)
+        if deadline is None:
+            await self.rate_limiter.acquire()
+        else:
+            try:
+                await asyncio.wait_for(self.rate_limiter.acquire(), deadline.budget())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Délai dépassé en attente de la limite de débit Notion")
+        
+        timeout = deadline.budget(NOTION_TIMEOUT) if deadline else NOTION_TIMEOUT
+        
+        async def call() -> Dict[str, Any]:
+            try:
+                return await asyncio.wait_for(method(**payload), timeout)
+            except asyncio.TimeoutError:
+                if timeout < NOTION_TIMEOUT:
+                    # Timeout réduit par le budget de l'appelant : neutre pour le breaker
+                    raise DeadlineExceeded("Délai dépassé pendant l'appel à Notion")
+                raise
+        
+        try:
+            return await self.circuit_breaker.call(call)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Notion n'a pas répondu en {timeout:.1f}s")
+    
   
     async def create_page(
         self,
         title: str,
         content: Optional[str] = None,
-        database_id: Optional[str] = None
+        database_id: Optional[str] = None,
+        deadline: Optional[Deadline] = None
     ) -> Dict[str, Any]:
         """
         Crée une page dans Notion
@@ -67,6 +197,7 @@ class NotionManager:
             title: Titre de la page
             content: Contenu de la page
             database_id: ID de la base de données (optionnel)
+            deadline: Échéance de la requête (borne l'attente et le timeout de l'appel)
             
         Returns:
             Dict avec le statut et les détails
@@ -115,7 +246,7 @@ class NotionManager:
                     }
                 ]
             
-            response = await self.client.pages.create(**new_page)
+            response = await self._pages_call("create", new_page, deadline)
             
             logger.info(f"Page created: {response.get('url')}")
             
@@ -126,6 +257,8 @@ class NotionManager:
                 "page_url": response.get("url")
             }
             
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
             logger.error(f"Error creating Notion page: {e}")
             return {
@@ -138,7 +271,8 @@ class NotionManager:
         title: str,
         due_date: Optional[str] = None,
         priority: str = "medium",
-        description: Optional[str] = None
+        description: Optional[str] = None,
+        deadline: Optional[Deadline] = None
     ) -> Dict[str, Any]:
         """
         Crée une tâche dans Notion
@@ -148,6 +282,7 @@ class NotionManager:
             due_date: Date d'échéance (YYYY-MM-DD)
             priority: Priorité (low, medium, high)
             description: Description de la tâche
+            deadline: Échéance de la requête (borne l'attente et le timeout de l'appel)
             
         Returns:
             Dict avec le statut et les détails
@@ -194,7 +329,7 @@ class NotionManager:
                     }
                 ]
             
-            response = await self.client.pages.create(**new_task)
+            response = await self._pages_call("create", new_task, deadline)
             logger.info(f"Task created: {response.get('url')}")
             
             return {
@@ -204,26 +339,202 @@ class NotionManager:
                 "task_url": response.get("url")
             }
             
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
             logger.error(f"Error creating Notion task: {e}")
             return {
                 "status": "error",
                 "message": f"Erreur lors de la création de la tâche: {str(e)}"
             }
+    
+    async def update_task(
+        self,
+        page_id: str,
+        title: Optional[str] = None,
+        due_date: Optional[str] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Dict[str, Any]:
+        """
+        Modifie une tâche (ou un événement) existante dans Notion
+        
+        Args:
+            page_id: ID de la page Notion à modifier
+            title: Nouveau titre (optionnel)
+            due_date: Nouvelle date d'échéance (YYYY-MM-DD ou ISO avec heure)
+            deadline: Échéance de la requête (borne l'attente et le timeout de l'appel)
+            
+        Returns:
+            Dict avec le statut et les détails
+        """
+        try:
+            properties = {}
+            if title:
+                properties["Name"] = {"title": [{"text": {"content": title}}]}
+            if due_date:
+                properties["Due Date"] = {"date": {"start": due_date}}
+            
+            if not properties:
+                return {
+                    "status": "error",
+                    "message": "Aucune modification demandée"
+                }
+            
+            response = await self._pages_call(
+                "update", {"page_id": page_id, "properties": properties}, deadline
+            )
+            logger.info(f"Task updated: {response.get('url')}")
+            
+            return {
+                "status": "success",
+                "message": "Tâche modifiée avec succès",
+                "task_id": response.get("id"),
+                "task_url": response.get("url")
+            }
+            
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
+        except Exception as e:
+            logger.error(f"Error updating Notion task: {e}")
+            return {
+                "status": "error",
+                "message": f"Erreur lors de la modification de la tâche: {str(e)}"
+            }
 
 
-# Instance globale
-_notion_manager = None
+class _PoolEntry:
+    """Client du pool et ses métadonnées d'utilisation"""
+    
+    def __init__(self, manager: NotionManager):
+        self.manager = manager
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.evicted = False
 
 
-def get_notion_manager() -> NotionManager:
-    """Récupère ou crée l'instance du gestionnaire Notion"""
-    global _notion_manager
+class NotionClientPool:
+    """
+    Pool de clients Notion, un par jeu d'identifiants
+    
+    - Éviction LRU au-delà de max_size et fermeture après idle_timeout d'inactivité
+      (vérifiée à chaque emprunt et par une tâche de fond démarrée avec start())
+    - Les clients évincés sont fermés (aclose) dès qu'ils ne sont plus utilisés
+    - Un limiteur de débit par token d'intégration (tenant_id), partagé par les
+      clients de plusieurs bases du même token et conservé après éviction
+    """
+    
+    def __init__(
+        self,
+        max_size: int = NOTION_POOL_SIZE,
+        idle_timeout: float = NOTION_POOL_IDLE_TIMEOUT
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._entries: "OrderedDict[NotionCredentials, _PoolEntry]" = OrderedDict()
+        self._rate_limiters: Dict[str, TokenBucket] = {}
+        self._lock = asyncio.Lock()
+        self._reaper_task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Démarre la fermeture périodique des clients inactifs (au démarrage de l'application)"""
+        if self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._reaper())
     
-    # Force refresh pour éviter le cache
-    _notion_manager = None
+    async def _reaper(self):
+        """Ferme les clients inactifs même quand plus aucune requête n'arrive"""
+        interval = max(1.0, self.idle_timeout / 2)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with self._lock:
+                    await self._evict_locked()
+            except Exception as e:
+                logger.error(f"Error reaping idle Notion clients: {e}")
+    
+    @asynccontextmanager
+    async def lease(self, credentials: Optional[NotionCredentials] = None) -> AsyncIterator[NotionManager]:
+        """
+        Emprunte le client Notion associé aux identifiants
+        
+        Args:
+            credentials: Identifiants du tenant (défaut : variables d'environnement)
+            
+        Yields:
+            NotionManager prêt à l'emploi
+        """
+        credentials = credentials or NotionCredentials.from_env()
+        
+        async with self._lock:
+            entry = self._entries.get(credentials)
+            if entry is None:
+                rate_limiter = self._rate_limiters.get(credentials.tenant_id)
+                if rate_limiter is None:
+                    rate_limiter = self._rate_limiters[credentials.tenant_id] = TokenBucket()
+                entry = _PoolEntry(NotionManager(credentials, rate_limiter))
+                self._entries[credentials] = entry
+                logger.info(f"Notion client created for tenant {credentials.tenant_id}")
+            else:
+                self._entries.move_to_end(credentials)
+            entry.in_use += 1
+            await self._evict_locked()
+        
+        try:
+            yield entry.manager
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            if entry.evicted and entry.in_use == 0:
+                await entry.manager.close()
+    
+    async def _evict_locked(self):
+        """Évince les clients inactifs puis les moins récemment utilisés"""
+        now = time.monotonic()
+        
+        for credentials, entry in list(self._entries.items()):
+            if entry.in_use == 0 and now - entry.last_used > self.idle_timeout:
+                await self._remove_locked(credentials)
+        
+        for credentials in list(self._entries):
+            if len(self._entries) <= self.max_size:
+                break
+            await self._remove_locked(credentials)
+        
+        # Un limiteur plein et sans client n'a plus d'état utile : on peut l'oublier
+        active = {credentials.tenant_id for credentials in self._entries}
+        for tenant_id, rate_limiter in list(self._rate_limiters.items()):
+            if tenant_id not in active and rate_limiter.is_idle():
+                del self._rate_limiters[tenant_id]
+    
+    async def _remove_locked(self, credentials: NotionCredentials):
+        """Retire un client du pool, en différant sa fermeture s'il est utilisé"""
+        entry = self._entries.pop(credentials)
+        entry.evicted = True
+        logger.debug(f"Notion client evicted for tenant {credentials.tenant_id}")
+        if entry.in_use == 0:
+            await entry.manager.close()
+    
+    async def close(self):
+        """Ferme tous les clients du pool (arrêt de l'application)"""
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+        async with self._lock:
+            for credentials in list(self._entries):
+                await self._remove_locked(credentials)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Instance globale
+_notion_pool = None
+
+
+def get_notion_pool() -> NotionClientPool:
+    """Récupère ou crée le pool de clients Notion"""
+    global _notion_pool
     
-    if _notion_manager is None:
-        _notion_manager = NotionManager()
+    if _notion_pool is None:
+        _notion_pool = NotionClientPool()
     
-    return _notion_manager
+    return _notion_pool
@@ -0,0 +1,287 @@
+"""
+Contrôle d'admission et délestage de charge pour /run et /parse
+
+Chaque étape du pipeline (LLM, Notion) a son propre plafond de requêtes en
+cours. Au-delà, les requêtes attendent dans une file bornée :
+- servie à tour de rôle par client (un client ne peut pas monopoliser la file)
+- avec un temps d'attente maximal (ADMISSION_QUEUE_TIMEOUT, ou moins si le
+  budget de la requête est plus court)
+- file pleine ou attente trop longue : rejet immédiat (503 + Retry-After)
+- trop de requêtes d'un même client : rejet immédiat (429 + Retry-After)
+
+Le plafond peut s'ajuster à la latence observée (ADMISSION_ADAPTIVE=1) :
+il augmente tant que la latence reste proche de la latence de référence et
+diminue dès qu'elle se dégrade. Sous surcharge, le débit reste au niveau de la
+capacité et la latence bornée, au lieu de s'effondrer pour tout le monde.
+"""
+import os
+import hmac
+import math
+import time
+import asyncio
+import logging
+import ipaddress
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from resilience import Deadline, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+# Plafonds initiaux de requêtes en cours par étape
+ADMISSION_LLM_CONCURRENCY = int(os.getenv("ADMISSION_LLM_CONCURRENCY", "8"))
+ADMISSION_NOTION_CONCURRENCY = int(os.getenv("ADMISSION_NOTION_CONCURRENCY", "16"))
+
+# File d'attente de chaque étape
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+
+# Requêtes simultanées (en cours + en attente) par client et par étape
+ADMISSION_CLIENT_LIMIT = int(os.getenv("ADMISSION_CLIENT_LIMIT", "4"))
+
+# Plafond adaptatif
+ADMISSION_ADAPTIVE = os.getenv("ADMISSION_ADAPTIVE", "0").lower() in ("1", "true", "yes")
+ADMISSION_MIN_CONCURRENCY = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "1"))
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64"))
+ADMISSION_LATENCY_TOLERANCE = float(os.getenv("ADMISSION_LATENCY_TOLERANCE", "2"))
+
+# Front-ends de confiance, seuls autorisés à identifier leurs utilisateurs (X-Client-Id) :
+# adresses ou réseaux séparés par des virgules, et/ou secret partagé (X-Frontend-Secret)
+ADMISSION_TRUSTED_PROXIES = [
+    ipaddress.ip_network(value.strip(), strict=False)
+    for value in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",") if value.strip()
+]
+ADMISSION_FRONTEND_SECRET = os.getenv("ADMISSION_FRONTEND_SECRET", "")
+
+STAGE_CONCURRENCY = {
+    "llm": ADMISSION_LLM_CONCURRENCY,
+    "notion": ADMISSION_NOTION_CONCURRENCY
+}
+
+
+class AdmissionRejected(Exception):
+    """La requête est refusée par le contrôle d'admission (surcharge)"""
+
+    def __init__(self, stage: str, reason: str, status_code: int, retry_after: float):
+        super().__init__(f"Service surchargé ({stage}) : {reason}")
+        self.stage = stage
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class StageLimiter:
+    """
+    Plafond de requêtes en cours d'une étape, avec file d'attente équitable
+
+    Quand une requête termine, sa place est donnée directement à la requête en
+    attente du client suivant (tourniquet entre clients).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        client_limit: int = ADMISSION_CLIENT_LIMIT,
+        adaptive: bool = ADMISSION_ADAPTIVE,
+        min_limit: int = ADMISSION_MIN_CONCURRENCY,
+        max_limit: int = ADMISSION_MAX_CONCURRENCY,
+        latency_tolerance: float = ADMISSION_LATENCY_TOLERANCE
+    ):
+        self.name = name
+        self.limit = float(limit)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.client_limit = client_limit
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, limit)
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        self._client_load: Dict[str, int] = {}
+
+        # Latence moyenne (estimation de Retry-After) et latence de référence (plafond adaptatif)
+        self.avg_latency = 1.0
+        self.baseline_latency: Optional[float] = None
+
+    @property
+    def capacity(self) -> int:
+        return max(1, int(self.limit))
+
+    def retry_after(self) -> float:
+        """Temps estimé avant qu'une place se libère pour une nouvelle requête"""
+        return self.avg_latency * (self.queued + 1) / self.capacity
+
+    def _reject(self, reason: str, status_code: int) -> AdmissionRejected:
+        self.rejected += 1
+        logger.warning(f"Admission '{self.name}' rejected a request: {reason}")
+        return AdmissionRejected(self.name, reason, status_code, self.retry_after())
+
+    async def acquire(self, client_id: str, deadline: Optional[Deadline] = None):
+        """
+        Attend une place dans l'étape
+
+        Raises:
+            AdmissionRejected: client trop gourmand (429), file pleine ou attente trop longue (503)
+            DeadlineExceeded: si le budget de la requête expire pendant l'attente
+        """
+        load = self._client_load.get(client_id, 0)
+        if load >= self.client_limit:
+            raise self._reject(f"trop de requêtes simultanées pour ce client ({load})", 429)
+
+        if self.in_flight < self.capacity and not self.queued:
+            self.in_flight += 1
+            self._client_load[client_id] = load + 1
+            return
+
+        if self.queued >= self.queue_size:
+            raise self._reject("file d'attente pleine", 503)
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline.remaining())
+        if timeout <= 0:
+            raise DeadlineExceeded(f"Délai de {deadline.timeout:.1f}s dépassé")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client_id, deque()).append(future)
+        self.queued += 1
+        self._client_load[client_id] = load + 1
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if future.done() and not future.cancelled():
+                # La place a été attribuée au même moment : on la rend
+                self.release(client_id)
+            else:
+                self._remove_waiter(client_id, future)
+                self._decrement_load(client_id)
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"Délai de {deadline.timeout:.1f}s dépassé")
+            raise self._reject(f"attente supérieure à {timeout:.1f}s", 503)
+
+    def release(self, client_id: str, latency: Optional[float] = None):
+        """Libère la place d'une requête terminée et la donne au prochain client en attente"""
+        self._decrement_load(client_id)
+        if latency is not None:
+            self._observe(latency)
+
+        self.in_flight -= 1
+        while self.in_flight < self.capacity and self._waiters:
+            waiter_client, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(waiter_client)
+            else:
+                del self._waiters[waiter_client]
+            self.queued -= 1
+            if future.done():
+                # Attente expirée, pas encore retirée de la file par acquire
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _remove_waiter(self, client_id: str, future: asyncio.Future):
+        waiters = self._waiters.get(client_id)
+        if waiters is None or future not in waiters:
+            return
+        waiters.remove(future)
+        if not waiters:
+            del self._waiters[client_id]
+        self.queued -= 1
+
+    def _decrement_load(self, client_id: str):
+        load = self._client_load.get(client_id, 0) - 1
+        if load > 0:
+            self._client_load[client_id] = load
+        else:
+            self._client_load.pop(client_id, None)
+
+    def _observe(self, latency: float):
+        """Met à jour les latences et, en mode adaptatif, le plafond (AIMD)"""
+        self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+        if not self.adaptive:
+            return
+
+        # La référence remonte lentement pour suivre un changement durable de la dépendance
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        else:
+            self.baseline_latency = min(latency, self.baseline_latency * 1.01)
+
+        if latency > self.baseline_latency * self.latency_tolerance:
+            self.limit = max(float(self.min_limit), self.limit * 0.9)
+        elif self.in_flight >= self.capacity:
+            # Plafond atteint avec une latence saine : on essaie une place de plus
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.capacity)
+
+    @asynccontextmanager
+    async def slot(self, client_id: str, deadline: Optional[Deadline] = None):
+        """Occupe une place de l'étape pendant le bloc"""
+        await self.acquire(client_id, deadline)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(client_id, time.monotonic() - start)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """État de l'étape pour /health"""
+        return {
+            "limit": self.capacity,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "avg_latency": round(self.avg_latency, 3)
+        }
+
+
+def is_trusted_frontend(host: Optional[str], secret: Optional[str]) -> bool:
+    """
+    Indique si la requête vient d'un front-end de confiance
+
+    Args:
+        host: Adresse IP de l'appelant
+        secret: Valeur de l'en-tête X-Frontend-Secret
+    """
+    if ADMISSION_FRONTEND_SECRET and secret and hmac.compare_digest(
+        secret.encode("utf-8"), ADMISSION_FRONTEND_SECRET.encode("utf-8")
+    ):
+        return True
+    if not host or not ADMISSION_TRUSTED_PROXIES:
+        return False
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in ADMISSION_TRUSTED_PROXIES)
+
+
+def retry_after_header(e: AdmissionRejected) -> str:
+    """Valeur de l'en-tête Retry-After (secondes entières, au moins 1)"""
+    return str(max(1, math.ceil(e.retry_after)))
+
+
+# Instances globales
+_stage_limiters: Dict[str, StageLimiter] = {}
+
+
+def get_stage_limiter(name: str) -> StageLimiter:
+    """Récupère ou crée le limiteur d'une étape (llm, notion)"""
+    if name not in _stage_limiters:
+        _stage_limiters[name] = StageLimiter(name, STAGE_CONCURRENCY.get(name, ADMISSION_LLM_CONCURRENCY))
+    return _stage_limiters[name]
+
+
+def get_stage_limiters() -> Dict[str, StageLimiter]:
+    """Tous les limiteurs créés"""
+    return _stage_limiters
@@ -0,0 +1,3 @@
+"""
+Benchmarks du parsing LLM (latence, tokens, validité JSON, précision)
+"""
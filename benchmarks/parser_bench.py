@@ -0,0 +1,399 @@
+"""
+Benchmark du parsing : latence, tokens, validité JSON et précision par champ
+
+Le corpus (benchmarks/corpus/<version>.jsonl) associe des requêtes d'étudiants à
+la sortie {"tasks": [...]} attendue. Chaque requête passe par
+LLMParser.parse_query, en mode :
+
+- replay (défaut) : les réponses HTTP d'OpenRouter sont rejouées depuis les
+  cassettes (benchmarks/cassettes/<version>/), hors ligne et déterministe
+- record : appel réel à OpenRouter et enregistrement des cassettes
+- live : appel réel sans enregistrement
+
+Une cassette est liée au modèle et au prompt exacts (hash de la requête) : après
+une modification du prompt de _meta_parse ou de META_MODEL, relancer en mode
+record pour mesurer la nouvelle version.
+
+Usage:
+    python -m benchmarks.parser_bench                       # replay + comparaison baseline
+    python -m benchmarks.parser_bench --mode record         # (ré)enregistre les cassettes
+    python -m benchmarks.parser_bench --update-baseline     # fige les métriques actuelles
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import importlib
+import statistics
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS = "v1"
+DEFAULT_PARSER = "llm:get_llm_parser"
+
+# Champs comparés entre la sortie attendue et la sortie obtenue
+COMPARED_FIELDS = (
+    "action", "app", "title", "date", "time", "duration_minutes", "due_date", "priority"
+)
+
+# Régressions tolérées par rapport à la baseline
+THRESHOLDS = {
+    "json_valid_rate": -0.0,       # aucune baisse tolérée
+    "field_accuracy": -0.02,       # baisse absolue
+    "task_count_accuracy": -0.05,  # baisse absolue
+    "latency_p95_ms": 0.20,        # hausse relative
+    "tokens_mean": 0.10,           # hausse relative
+}
+
+STOP_WORDS = {"de", "du", "des", "d", "le", "la", "les", "l", "un", "une", "pour", "a", "au", "aux", "et", "mon", "ma", "mes"}
+
+
+class _RecordedResponse:
+    """Réponse HTTP rejouée depuis une cassette"""
+
+    def __init__(self, body: Dict[str, Any]):
+        self.status_code = 200
+        self._body = body
+
+    def json(self) -> Dict[str, Any]:
+        return self._body
+
+
+class CassetteTransport:
+    """
+    Remplace LLMParser._post pour rejouer / enregistrer les appels OpenRouter
+
+    Mémorise aussi la latence et l'usage de tokens du dernier appel.
+    """
+
+    def __init__(self, directory: str, mode: str, real_post):
+        self.directory = directory
+        self.mode = mode
+        self.real_post = real_post
+        self.query_id: Optional[str] = None
+        self.last_usage: Dict[str, int] = {}
+        self.last_latency_ms: Optional[float] = None
+        # Erreur de cassette (manquante / obsolète) : le parser l'enveloppe, on la garde ici
+        self.cassette_error: Optional[str] = None
+
+    @staticmethod
+    def request_hash(payload: Dict[str, Any]) -> str:
+        key = {"model": payload.get("model"), "messages": payload.get("messages")}
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, f"{self.query_id}.json")
+
+    def __call__(self, url: str, headers: Dict[str, str], payload: Dict[str, Any], timeout: float):
+        request_hash = self.request_hash(payload)
+
+        if self.mode == "replay":
+            path = self._path()
+            if not os.path.exists(path):
+                self.cassette_error = f"Cassette manquante : {path} (lancer --mode record)"
+                raise LookupError(self.cassette_error)
+            with open(path, "r", encoding="utf-8") as f:
+                cassette = json.load(f)
+            if cassette["request_hash"] != request_hash:
+                self.cassette_error = f"Cassette obsolète (prompt ou modèle modifié) : {path}"
+                raise LookupError(self.cassette_error)
+            self.last_latency_ms = cassette["latency_ms"]
+            self.last_usage = cassette["response"].get("usage") or {}
+            return _RecordedResponse(cassette["response"])
+
+        start = time.perf_counter()
+        response = self.real_post(url, headers, payload, timeout)
+        self.last_latency_ms = (time.perf_counter() - start) * 1000
+        body = response.json()
+        self.last_usage = body.get("usage") or {}
+
+        if self.mode == "record":
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(), "w", encoding="utf-8") as f:
+                json.dump({
+                    "request_hash": request_hash,
+                    "model": payload.get("model"),
+                    "latency_ms": round(self.last_latency_ms, 1),
+                    "response": body
+                }, f, ensure_ascii=False, indent=2)
+
+        return response
+
+
+# ---------------------------------------------------------------------------
+# Comparaison des sorties
+# ---------------------------------------------------------------------------
+
+def _words(text: str) -> set:
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return {w for w in re.findall(r"[a-z0-9]+", text) if w not in STOP_WORDS}
+
+
+def _title_similarity(a: Any, b: Any) -> float:
+    wa, wb = _words(a or ""), _words(b or "")
+    if not wa and not wb:
+        return 1.0
+    return len(wa & wb) / len(wa | wb)
+
+
+def _normalize(field: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if field in ("date", "due_date"):
+        return str(value)[:10]
+    if field == "time":
+        hours, _, minutes = str(value).partition(":")
+        return f"{int(hours):02d}:{(minutes or '00')[:2]}" if hours.isdigit() else str(value)
+    if field == "duration_minutes":
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+    return str(value).lower()
+
+
+def _field_matches(field: str, expected: Any, actual: Any) -> bool:
+    if field == "title":
+        return _title_similarity(expected, actual) >= 0.5
+    return _normalize(field, expected) == _normalize(field, actual)
+
+
+def _match_tasks(expected: List[Dict], actual: List[Dict]) -> List[Tuple[Dict, Optional[Dict]]]:
+    """Associe chaque tâche attendue à la tâche obtenue la plus proche (même action)"""
+    remaining = list(actual)
+    pairs = []
+    for exp in expected:
+        candidates = [t for t in remaining if t.get("action") == exp.get("action")] or remaining
+        if not candidates:
+            pairs.append((exp, None))
+            continue
+        best = max(candidates, key=lambda t: _title_similarity(exp.get("title"), t.get("title")))
+        remaining.remove(best)
+        pairs.append((exp, best))
+    return pairs
+
+
+def score_output(expected: Dict[str, Any], actual: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Compare une sortie au résultat attendu, champ par champ"""
+    expected_tasks = expected.get("tasks", [])
+    actual_tasks = (actual or {}).get("tasks", []) if isinstance(actual, dict) else []
+    if not isinstance(actual_tasks, list):
+        actual_tasks = []
+    actual_tasks = [task for task in actual_tasks if isinstance(task, dict)]
+
+    total = matched = 0
+    mismatches = []
+    for exp, act in _match_tasks(expected_tasks, actual_tasks):
+        for field in COMPARED_FIELDS:
+            if field not in exp:
+                continue
+            total += 1
+            if act is not None and _field_matches(field, exp[field], act.get(field)):
+                matched += 1
+            else:
+                mismatches.append({
+                    "field": field,
+                    "expected": exp[field],
+                    "actual": None if act is None else act.get(field)
+                })
+
+    return {
+        "fields_total": total,
+        "fields_matched": matched,
+        "task_count_ok": len(expected_tasks) == len(actual_tasks),
+        "mismatches": mismatches
+    }
+
+
+# ---------------------------------------------------------------------------
+# Exécution
+# ---------------------------------------------------------------------------
+
+def load_corpus(version: str) -> List[Dict[str, Any]]:
+    path = os.path.join(BENCH_DIR, "corpus", f"{version}.jsonl")
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_parser(spec: str):
+    """Instancie un parser depuis "module:fabrique" (ex: llm:get_llm_parser)"""
+    module_name, _, factory_name = spec.partition(":")
+    factory = getattr(importlib.import_module(module_name), factory_name)
+    return factory()
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_benchmark(
+    corpus_version: str,
+    parser_spec: str,
+    mode: str,
+    cassette_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Exécute le corpus et calcule les métriques
+
+    Args:
+        corpus_version: Version du corpus (benchmarks/corpus/<version>.jsonl)
+        parser_spec: Fabrique du parser ("module:fonction")
+        mode: replay, record ou live
+        cassette_dir: Répertoire des cassettes (défaut : benchmarks/cassettes/<version>)
+
+    Returns:
+        Dict avec les métriques agrégées et le détail par requête
+    """
+    corpus = load_corpus(corpus_version)
+    parser = load_parser(parser_spec)
+
+    transport = None
+    if getattr(parser, "backend", "openrouter") == "openrouter" and hasattr(parser, "_post"):
+        transport = CassetteTransport(
+            cassette_dir or os.path.join(BENCH_DIR, "cassettes", corpus_version), mode, parser._post
+        )
+        parser._post = transport
+    elif mode != "live":
+        raise SystemExit(f"Le parser {parser_spec} ne passe pas par HTTP : utiliser --mode live")
+
+    per_query = []
+    for item in corpus:
+        if transport:
+            transport.query_id = item["id"]
+            transport.last_usage, transport.last_latency_ms = {}, None
+
+        start = time.perf_counter()
+        error = None
+        try:
+            output = await parser.parse_query(item["query"])
+        except Exception as e:
+            if transport and transport.cassette_error:
+                raise SystemExit(transport.cassette_error)
+            output, error = None, str(e)
+        measured_ms = (time.perf_counter() - start) * 1000
+
+        usage = transport.last_usage if transport else {}
+        latency_ms = transport.last_latency_ms if transport and transport.last_latency_ms is not None else measured_ms
+        score = score_output(item["expected"], output)
+
+        per_query.append({
+            "id": item["id"],
+            "latency_ms": round(latency_ms, 1),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "json_valid": error is None and isinstance(output, dict) and isinstance(output.get("tasks"), list),
+            "error": error,
+            **score
+        })
+
+    latencies = [q["latency_ms"] for q in per_query]
+    tokens = [q["prompt_tokens"] + q["completion_tokens"] for q in per_query]
+    fields_total = sum(q["fields_total"] for q in per_query)
+
+    metrics = {
+        "queries": len(per_query),
+        "json_valid_rate": sum(q["json_valid"] for q in per_query) / len(per_query),
+        "field_accuracy": sum(q["fields_matched"] for q in per_query) / fields_total if fields_total else 0.0,
+        "task_count_accuracy": sum(q["task_count_ok"] for q in per_query) / len(per_query),
+        "latency_p50_ms": round(_percentile(latencies, 0.5), 1),
+        "latency_p95_ms": round(_percentile(latencies, 0.95), 1),
+        "tokens_mean": round(statistics.mean(tokens), 1) if tokens else 0.0,
+        "prompt_tokens_mean": round(statistics.mean(q["prompt_tokens"] for q in per_query), 1),
+        "completion_tokens_mean": round(statistics.mean(q["completion_tokens"] for q in per_query), 1),
+    }
+
+    return {
+        "corpus": corpus_version,
+        "parser": parser_spec,
+        "model": getattr(parser, "meta_model", None),
+        "mode": mode,
+        "metrics": metrics,
+        "per_query": per_query
+    }
+
+
+def compare_to_baseline(metrics: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Liste les régressions au-delà des seuils (vide si aucune)"""
+    regressions = []
+    for name, threshold in THRESHOLDS.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name], metrics[name]
+        if name in ("latency_p95_ms", "tokens_mean"):
+            if old > 0 and (new - old) / old > threshold:
+                regressions.append(f"{name}: {old} -> {new} (+{(new - old) / old:.0%}, seuil +{threshold:.0%})")
+        elif new - old < threshold:
+            regressions.append(f"{name}: {old:.3f} -> {new:.3f} (seuil {threshold:+.2f})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark du parsing LLM")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="Version du corpus")
+    parser.add_argument("--parser", default=DEFAULT_PARSER, help="Fabrique du parser (module:fonction)")
+    parser.add_argument("--mode", choices=("replay", "record", "live"), default="replay")
+    parser.add_argument("--cassettes", default=None, help="Répertoire des cassettes (défaut : cassettes/<corpus>)")
+    parser.add_argument("--baseline", default=None, help="Fichier baseline (défaut : baseline_<corpus>.json)")
+    parser.add_argument("--update-baseline", action="store_true", help="Enregistre les métriques comme baseline")
+    parser.add_argument(
+        "--allow-missing-baseline", action="store_true",
+        help="Réussit sans comparaison si la baseline est absente (premier enregistrement)"
+    )
+    parser.add_argument("--report", default=None, help="Écrit le rapport complet (JSON) dans ce fichier")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    if args.mode == "replay":
+        # Aucun appel réseau en replay : une clé factice suffit
+        os.environ.setdefault("META_API_KEY", "replay")
+
+    report = asyncio.run(run_benchmark(args.corpus, args.parser, args.mode, args.cassettes))
+    metrics = report["metrics"]
+
+    print(json.dumps(metrics, ensure_ascii=False, indent=2))
+    for query in report["per_query"]:
+        if query["mismatches"] or query["error"]:
+            print(f"- {query['id']}: {query['error'] or query['mismatches']}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    baseline_path = args.baseline or os.path.join(BENCH_DIR, f"baseline_{args.corpus}.json")
+    if args.update_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=2)
+        print(f"Baseline écrite : {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print(f"Pas de baseline ({baseline_path}) : lancer --update-baseline")
+        # Sans baseline, aucune régression ne peut être détectée : échec en CI
+        return 0 if args.allow_missing_baseline else 2
+
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        regressions = compare_to_baseline(metrics, json.load(f))
+
+    if regressions:
+        print("Régressions détectées :")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+
+    print("Aucune régression par rapport à la baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Tests hors ligne du benchmark : scoring, comparaison à la baseline et rejeu
+
+Les cassettes utilisées ici sont construites à partir des sorties attendues du
+corpus (modèle « parfait ») : elles vérifient le harnais, pas le modèle.
+
+    python -m pytest benchmarks
+"""
+import json
+import asyncio
+
+import pytest
+
+from benchmarks import parser_bench
+from benchmarks.parser_bench import CassetteTransport, compare_to_baseline, load_corpus, score_output
+
+
+EXPECTED = {"tasks": [
+    {"action": "create_event", "app": "notion", "title": "Examen de maths", "date": "2026-01-20", "time": "10:00"},
+    {"action": "create_page", "app": "notion", "title": "Révision maths"}
+]}
+
+
+def test_score_output_exact_match():
+    score = score_output(EXPECTED, json.loads(json.dumps(EXPECTED)))
+    assert score["fields_matched"] == score["fields_total"] == 8
+    assert score["task_count_ok"]
+    assert score["mismatches"] == []
+
+
+def test_score_output_normalizes_fields_and_order():
+    actual = {"tasks": [
+        {"action": "create_page", "app": "Notion", "title": "revision des maths"},
+        {"action": "create_event", "app": "notion", "title": "examen maths", "date": "2026-01-20T10:00:00", "time": "10:00"}
+    ]}
+    score = score_output(EXPECTED, actual)
+    assert score["fields_matched"] == 8
+    assert score["task_count_ok"]
+
+
+def test_score_output_reports_mismatches():
+    actual = {"tasks": [{"action": "create_event", "app": "notion", "title": "Examen de maths", "date": "2026-01-21", "time": "9:00"}]}
+    score = score_output(EXPECTED, actual)
+    assert not score["task_count_ok"]
+    fields = [m["field"] for m in score["mismatches"]]
+    assert fields == ["date", "time", "action", "app", "title"]
+
+
+@pytest.mark.parametrize("actual", [None, "texte", {"tasks": "x"}, {"tasks": [1, None]}])
+def test_score_output_invalid_output(actual):
+    score = score_output(EXPECTED, actual)
+    assert score["fields_matched"] == 0
+    assert not score["task_count_ok"]
+
+
+def test_compare_to_baseline():
+    baseline = {
+        "json_valid_rate": 1.0, "field_accuracy": 0.95, "task_count_accuracy": 1.0,
+        "latency_p95_ms": 1000.0, "tokens_mean": 400.0
+    }
+    assert compare_to_baseline(dict(baseline), baseline) == []
+
+    within = dict(baseline, field_accuracy=0.94, latency_p95_ms=1150.0, tokens_mean=430.0)
+    assert compare_to_baseline(within, baseline) == []
+
+    regressed = dict(baseline, json_valid_rate=0.9, field_accuracy=0.9, latency_p95_ms=1300.0, tokens_mean=500.0)
+    names = [line.split(":")[0] for line in compare_to_baseline(regressed, baseline)]
+    assert names == ["json_valid_rate", "field_accuracy", "latency_p95_ms", "tokens_mean"]
+
+
+def _write_cassettes(directory, model):
+    """Cassettes dont la réponse est la sortie attendue de chaque requête du corpus"""
+    from llm import build_messages
+
+    for item in load_corpus(parser_bench.DEFAULT_CORPUS):
+        payload = {"model": model, "messages": build_messages(item["query"])}
+        with open(directory / f"{item['id']}.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "request_hash": CassetteTransport.request_hash(payload),
+                "model": model,
+                "latency_ms": 100.0,
+                "response": {
+                    "choices": [{"message": {"content": json.dumps(item["expected"], ensure_ascii=False)}}],
+                    "usage": {"prompt_tokens": 300, "completion_tokens": 50}
+                }
+            }, f)
+
+
+def test_replay_is_offline_and_deterministic(tmp_path, monkeypatch):
+    monkeypatch.setenv("META_API_KEY", "replay")
+    monkeypatch.setenv("META_MODEL", "bench-model")
+    _write_cassettes(tmp_path, "bench-model")
+
+    report = asyncio.run(parser_bench.run_benchmark(
+        parser_bench.DEFAULT_CORPUS, "llm:LLMParser", "replay", str(tmp_path)
+    ))
+    metrics = report["metrics"]
+    assert metrics["json_valid_rate"] == 1.0
+    assert metrics["field_accuracy"] == 1.0
+    assert metrics["task_count_accuracy"] == 1.0
+    assert metrics["latency_p95_ms"] == 100.0
+    assert metrics["tokens_mean"] == 350.0
+
+
+def test_replay_detects_stale_cassette(tmp_path, monkeypatch):
+    monkeypatch.setenv("META_API_KEY", "replay")
+    monkeypatch.setenv("META_MODEL", "autre-modele")
+    _write_cassettes(tmp_path, "bench-model")
+
+    with pytest.raises(SystemExit, match="obsolète"):
+        asyncio.run(parser_bench.run_benchmark(
+            parser_bench.DEFAULT_CORPUS, "llm:LLMParser", "replay", str(tmp_path)
+        ))
+
+
+def test_missing_baseline_fails_unless_allowed(tmp_path, monkeypatch):
+    monkeypatch.setenv("META_API_KEY", "replay")
+    monkeypatch.setenv("META_MODEL", "bench-model")
+    _write_cassettes(tmp_path, "bench-model")
+    args = ["--cassettes", str(tmp_path), "--baseline", str(tmp_path / "absente.json")]
+
+    assert parser_bench.main(args) == 2
+    assert parser_bench.main(args + ["--allow-missing-baseline"]) == 0
@@ -0,0 +1,366 @@
+"""
+Historique des requêtes /run
+
+Chaque exécution est ajoutée (append-only) dans une base SQLite locale :
+- une ligne compacte par requête (métadonnées indexées + détail compressé)
+- index secondaires par tenant : date, statut et type d'action
+- écritures regroupées par un writer en tâche de fond, hors du chemin de /run
+- pagination par curseur (id décroissant) pour rester rapide sur des millions
+  d'enregistrements
+- compaction périodique selon la durée de rétention
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "data/history.db")
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "10000"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1"))
+HISTORY_COMPACTION_INTERVAL = float(os.getenv("HISTORY_COMPACTION_INTERVAL", "3600"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    status TEXT NOT NULL,
+    query TEXT NOT NULL,
+    execution_time REAL,
+    tenant TEXT,
+    payload BLOB
+);
+CREATE INDEX IF NOT EXISTS history_ts ON history (ts);
+CREATE INDEX IF NOT EXISTS history_tenant ON history (tenant, id);
+CREATE INDEX IF NOT EXISTS history_tenant_status ON history (tenant, status, id);
+CREATE INDEX IF NOT EXISTS history_tenant_ts ON history (tenant, ts);
+DROP INDEX IF EXISTS history_status;
+CREATE TABLE IF NOT EXISTS history_actions (
+    tenant TEXT NOT NULL,
+    action TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    PRIMARY KEY (tenant, action, record_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_actions_record ON history_actions (record_id);
+"""
+
+# Bases créées avant l'ajout du tenant dans history_actions : reconstruction en une transaction
+MIGRATE_ACTIONS = f"""
+BEGIN;
+ALTER TABLE history_actions RENAME TO history_actions_legacy;
+{SCHEMA}
+INSERT OR IGNORE INTO history_actions (tenant, action, record_id)
+    SELECT COALESCE(h.tenant, ''), a.action, a.record_id
+    FROM history_actions_legacy a JOIN history h ON h.id = a.record_id;
+DROP TABLE history_actions_legacy;
+COMMIT;
+"""
+
+
+def _encode_payload(payload: Dict[str, Any]) -> bytes:
+    """Détail d'un enregistrement : JSON compact compressé"""
+    return zlib.compress(json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+
+def _decode_payload(blob: Optional[bytes]) -> Optional[Dict[str, Any]]:
+    if blob is None:
+        return None
+    return json.loads(zlib.decompress(blob))
+
+
+def summarize_status(results: List[Dict[str, Any]], error: Optional[str] = None) -> str:
+    """Statut global d'une exécution : success, partial ou error"""
+    if error is not None or not results:
+        return "error"
+    statuses = {result.get("status") for result in results}
+    if statuses <= {"success", "mock"}:
+        return "success"
+    if "success" in statuses or "mock" in statuses:
+        return "partial"
+    return "error"
+
+
+class HistoryStore:
+    """Stockage append-only de l'historique avec écritures par lots"""
+
+    def __init__(self, path: str = HISTORY_DB_PATH, retention_days: float = HISTORY_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._write_conn = self._connect(init=True)
+        action_columns = [row[1] for row in self._write_conn.execute("PRAGMA table_info(history_actions)")]
+        if action_columns and "tenant" not in action_columns:
+            logger.info("Migrating history_actions to tenant-scoped keys")
+            self._write_conn.executescript(MIGRATE_ACTIONS)
+        self._write_conn.executescript(SCHEMA)
+        if self._write_conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Base créée sans auto_vacuum : conversion unique, sinon compact() ne réduit jamais le fichier
+            logger.info("Enabling incremental auto_vacuum on history database")
+            self._write_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._write_conn.execute("VACUUM")
+        self._read_conn = self._connect()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._last_compaction = 0.0
+
+    def _connect(self, init: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        if init:
+            # Doit précéder le passage en WAL pour être pris en compte sur une base neuve
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    # ------------------------------------------------------------------
+    # Écriture
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Démarre le writer en tâche de fond (au démarrage de l'application)"""
+        if self._writer_task is None:
+            self._queue = asyncio.Queue(maxsize=HISTORY_QUEUE_SIZE)
+            self._writer_task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        """Écrit les enregistrements en attente puis arrête le writer"""
+        if self._writer_task is None:
+            return
+        await self._queue.put(None)
+        await self._writer_task
+        self._writer_task = None
+
+    def append(
+        self,
+        query: str,
+        parsed_tasks: Optional[Dict[str, Any]],
+        results: List[Dict[str, Any]],
+        execution_time: float,
+        tenant: Optional[str] = None,
+        error: Optional[str] = None
+    ):
+        """
+        Ajoute une exécution à l'historique sans bloquer l'appelant
+
+        Si la file est pleine (base indisponible), l'enregistrement est abandonné.
+        """
+        if self._queue is None:
+            return
+
+        actions = sorted({task.get("action") for task in (parsed_tasks or {}).get("tasks", [])
+                          if isinstance(task, dict) and task.get("action")})
+        record = {
+            "ts": time.time(),
+            "status": summarize_status(results, error),
+            "query": query,
+            "execution_time": execution_time,
+            "tenant": tenant,
+            "actions": actions,
+            "payload": {"parsed_tasks": parsed_tasks, "results": results, "error": error}
+        }
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            logger.warning("History queue full, dropping record")
+
+    async def _writer(self):
+        """Vide la file par lots (HISTORY_BATCH_SIZE ou HISTORY_FLUSH_INTERVAL)"""
+        stopping = False
+        while not stopping:
+            batch = []
+            item = await self._queue.get()
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+                deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+                while len(batch) < HISTORY_BATCH_SIZE:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+            try:
+                if batch:
+                    await asyncio.to_thread(self._write_batch, batch)
+                if time.monotonic() - self._last_compaction > HISTORY_COMPACTION_INTERVAL:
+                    self._last_compaction = time.monotonic()
+                    await asyncio.to_thread(self.compact)
+            except Exception as e:
+                logger.error(f"Error writing history: {e}")
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        """Écrit un lot dans une seule transaction"""
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute("BEGIN")
+            try:
+                for record in batch:
+                    cursor = conn.execute(
+                        "INSERT INTO history (ts, status, query, execution_time, tenant, payload) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (record["ts"], record["status"], record["query"], record["execution_time"],
+                         record["tenant"], _encode_payload(record["payload"]))
+                    )
+                    # Identifiants par défaut (tenant None) : clé '' (colonne de clé primaire)
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO history_actions (tenant, action, record_id) VALUES (?, ?, ?)",
+                        [(record["tenant"] or "", action, cursor.lastrowid) for action in record["actions"]]
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def compact(self, chunk_size: int = 10000) -> int:
+        """
+        Supprime les enregistrements plus anciens que la rétention
+
+        Returns:
+            Nombre d'enregistrements supprimés
+        """
+        cutoff = time.time() - self.retention_days * 86400
+        deleted = 0
+        while True:
+            with self._write_lock:
+                conn = self._write_conn
+                ids = [row[0] for row in conn.execute(
+                    "SELECT id FROM history WHERE ts < ? ORDER BY ts LIMIT ?", (cutoff, chunk_size)
+                )]
+                if not ids:
+                    break
+                placeholders = ",".join("?" * len(ids))
+                conn.execute("BEGIN")
+                conn.execute(f"DELETE FROM history_actions WHERE record_id IN ({placeholders})", ids)
+                conn.execute(f"DELETE FROM history WHERE id IN ({placeholders})", ids)
+                conn.execute("COMMIT")
+                deleted += len(ids)
+
+        if deleted:
+            with self._write_lock:
+                # execute() n'exécute qu'une étape (une page libérée) : executescript va jusqu'au bout
+                self._write_conn.executescript("PRAGMA incremental_vacuum")
+            logger.info(f"History compaction: {deleted} record(s) removed")
+        return deleted
+
+    # ------------------------------------------------------------------
+    # Lecture
+    # ------------------------------------------------------------------
+
+    def query(
+        self,
+        limit: int = 50,
+        cursor: Optional[int] = None,
+        status: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        tenant: Optional[str] = None,
+        include_details: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Lit une page de l'historique d'un tenant, du plus récent au plus ancien
+
+        Args:
+            limit: Nombre maximum d'enregistrements
+            cursor: Valeur next_cursor de la page précédente
+            status: Filtre sur le statut (success, partial, error)
+            action: Filtre sur un type d'action (create_event...)
+            since / until: Bornes sur l'horodatage (epoch secondes)
+            tenant: Tenant Notion dont on lit l'historique (None : identifiants par défaut)
+            include_details: Inclut parsed_tasks et les résultats
+
+        Returns:
+            Dict avec "items" et "next_cursor" (None en fin d'historique)
+        """
+        columns = "h.id, h.ts, h.status, h.query, h.execution_time, h.tenant"
+        if include_details:
+            columns += ", h.payload"
+
+        where, params = [], []
+        if action:
+            # CROSS JOIN impose history_actions en table externe : parcours de sa clé
+            # (tenant, action, record_id) par ordre décroissant, sans tri
+            sql = f"SELECT {columns} FROM history_actions a CROSS JOIN history h ON h.id = a.record_id"
+            where.extend(["a.tenant = ?", "a.action = ?"])
+            params.extend([tenant or "", action])
+            id_column = "a.record_id"
+        else:
+            sql = f"SELECT {columns} FROM history h"
+            id_column = "h.id"
+        # Toujours filtré : un tenant ne voit jamais l'historique des autres
+        where.append("h.tenant IS ?")
+        params.append(tenant)
+        if cursor is not None:
+            where.append(f"{id_column} < ?")
+            params.append(cursor)
+        if status:
+            where.append("h.status = ?")
+            params.append(status)
+        if since is not None:
+            where.append("h.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("h.ts < ?")
+            params.append(until)
+        sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {id_column} DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._read_lock:
+            rows = self._read_conn.execute(sql, params).fetchall()
+
+        items = []
+        for row in rows[:limit]:
+            item = {
+                "id": row[0],
+                "timestamp": row[1],
+                "status": row[2],
+                "query": row[3],
+                "execution_time": row[4],
+                "tenant": row[5]
+            }
+            if include_details:
+                item.update(_decode_payload(row[6]) or {})
+            items.append(item)
+
+        return {
+            "items": items,
+            "next_cursor": items[-1]["id"] if len(rows) > limit else None
+        }
+
+
+# Instance globale
+_history_store = None
+
+
+def get_history_store() -> HistoryStore:
+    """Récupère ou crée le stockage de l'historique"""
+    global _history_store
+
+    if _history_store is None:
+        _history_store = HistoryStore()
+
+    return _history_store
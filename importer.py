@@ -0,0 +1,567 @@
+"""
+Import direct de calendriers (ICS / CSV) vers Notion, sans passer par le LLM
+
+Les entrées sont lues en streaming, converties directement en actions
+create_event / create_task (les événements récurrents sont développés en une
+entrée par occurrence), puis exécutées par l'ActionRunner avec une
+concurrence bornée. Chaque entrée importée est ajoutée à un registre (ledger) sur
+disque : une importation interrompue reprend là où elle s'était arrêtée et les
+entrées déjà importées sont ignorées.
+
+Usage CLI:
+    python importer.py emploi_du_temps.ics --concurrency 4
+"""
+import os
+import re
+import csv
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterator, Iterable, List, Optional, Set, TextIO, Tuple
+
+from dateutil.rrule import rrulestr
+
+from models import ActionResult
+from actions.notion import NotionCredentials
+from resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "4"))
+DEFAULT_LEDGER_PATH = os.getenv("IMPORT_LEDGER_PATH", "data/imported.txt")
+
+# Nombre maximal d'occurrences développées par événement récurrent (RRULE sans fin)
+IMPORT_MAX_OCCURRENCES = int(os.getenv("IMPORT_MAX_OCCURRENCES", "366"))
+
+# Une entrée à importer : (clé de déduplication, action au format du LLM)
+ImportEntry = Tuple[str, Dict[str, Any]]
+
+
+# ---------------------------------------------------------------------------
+# Lecture ICS
+# ---------------------------------------------------------------------------
+
+def _unfold_lines(stream: Iterable[str]) -> Iterator[str]:
+    """Recolle les lignes ICS repliées (RFC 5545 §3.1) sans charger tout le fichier"""
+    current = None
+    for raw in stream:
+        line = raw.rstrip("\r\n")
+        if line[:1] in (" ", "\t"):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _unescape(value: str) -> str:
+    """Décode les échappements texte ICS"""
+    return (
+        value.replace("\\n", "\n")
+        .replace("\\N", "\n")
+        .replace("\\,", ",")
+        .replace("\\;", ";")
+        .replace("\\\\", "\\")
+    )
+
+
+def _parse_ics_datetime(value: str, params: str) -> Tuple[str, Optional[str], Optional[datetime]]:
+    """
+    Convertit une date ICS en (date YYYY-MM-DD, heure HH:MM ou None, datetime ou None)
+
+    Les dates UTC (suffixe Z) sont converties dans le fuseau local du serveur.
+    """
+    if "VALUE=DATE" in params.upper() and "T" not in value:
+        day = datetime.strptime(value[:8], "%Y%m%d")
+        return day.strftime("%Y-%m-%d"), None, None
+
+    if value.endswith("Z"):
+        dt = datetime.strptime(value[:-1], "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc)
+        dt = dt.astimezone().replace(tzinfo=None)
+    elif "T" in value:
+        dt = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    else:
+        day = datetime.strptime(value[:8], "%Y%m%d")
+        return day.strftime("%Y-%m-%d"), None, None
+
+    return dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M"), dt
+
+
+def _ics_component_to_entry(kind: str, props: Dict[str, Tuple[str, str]]) -> Optional[ImportEntry]:
+    """Convertit un VEVENT / VTODO en action"""
+    title = _unescape(props.get("SUMMARY", ("", ""))[1]).strip() or "Sans titre"
+    description = _unescape(props.get("DESCRIPTION", ("", ""))[1]).strip()
+    location = _unescape(props.get("LOCATION", ("", ""))[1]).strip()
+    if location:
+        description = f"📍 {location}\n{description}".strip()
+
+    if kind == "VEVENT":
+        if "DTSTART" not in props:
+            return None
+        params, value = props["DTSTART"]
+        date, time, start = _parse_ics_datetime(value, params)
+
+        task = {
+            "action": "create_event",
+            "app": "notion",
+            "title": title,
+            "date": date,
+            "time": time or "00:00",
+            "description": description
+        }
+        if start is not None and "DTEND" in props:
+            _, _, end = _parse_ics_datetime(props["DTEND"][1], props["DTEND"][0])
+            if end is not None:
+                task["duration_minutes"] = int((end - start).total_seconds() // 60)
+        key_suffix = value
+    else:
+        task = {
+            "action": "create_task",
+            "app": "notion",
+            "title": title,
+            "priority": "medium",
+            "description": description or None
+        }
+        if "DUE" in props:
+            task["due_date"] = _parse_ics_datetime(props["DUE"][1], props["DUE"][0])[0]
+        priority = props.get("PRIORITY", ("", ""))[1]
+        if priority.isdigit() and int(priority) > 0:
+            # RFC 5545 : 1-4 haute, 5 moyenne, 6-9 basse
+            level = int(priority)
+            task["priority"] = "high" if level < 5 else "medium" if level == 5 else "low"
+        key_suffix = task.get("due_date", "")
+
+    uid = props.get("UID", ("", ""))[1]
+    if uid:
+        # DTSTART dans la clé : les occurrences modifiées d'un événement récurrent partagent l'UID
+        key = f"ics:{uid}:{key_suffix}"
+    else:
+        key = "ics:" + hashlib.sha1(repr(sorted(task.items())).encode("utf-8")).hexdigest()
+
+    return key, task
+
+
+def _ics_naive(value: str) -> datetime:
+    """Date ICS brute en datetime naïf, dans son propre repère (UTC si suffixe Z)"""
+    value = value.strip()
+    if "T" in value:
+        return datetime.strptime(value.rstrip("Z")[:15], "%Y%m%dT%H%M%S")
+    return datetime.strptime(value[:8], "%Y%m%d")
+
+
+def _format_ics(dt: datetime, like: str) -> str:
+    """Formate une occurrence comme la valeur DTSTART d'origine (date seule, UTC ou locale)"""
+    if "T" not in like:
+        return dt.strftime("%Y%m%d")
+    return dt.strftime("%Y%m%dT%H%M%S") + ("Z" if like.endswith("Z") else "")
+
+
+def _expand_recurrence(
+    props: Dict[str, Tuple[str, str]],
+    overridden: Set[datetime],
+    counters: Dict[str, int]
+) -> Iterator[ImportEntry]:
+    """
+    Développe un VEVENT récurrent (RRULE) en une entrée par occurrence
+
+    Les occurrences exclues (EXDATE) ou remplacées par un VEVENT RECURRENCE-ID
+    sont ignorées. Chaque occurrence a sa propre clé (UID + date de l'occurrence).
+    """
+    dtstart_params, dtstart = props["DTSTART"]
+    start = _ics_naive(dtstart)
+    duration = None
+    if "DTEND" in props:
+        duration = _ics_naive(props["DTEND"][1]) - start
+
+    # DTSTART est naïf : UNTIL est lu dans le même repère
+    rule = re.sub(r"(UNTIL=[0-9T]+)Z", r"\1", props["RRULE"][1])
+    excluded = set(overridden)
+    for value in props.get("EXDATE", ("", ""))[1].split(","):
+        if value.strip():
+            excluded.add(_ics_naive(value))
+
+    occurrences = 0
+    for occurrence in rrulestr(rule, dtstart=start):
+        if occurrences >= IMPORT_MAX_OCCURRENCES:
+            counters["recurring_truncated"] = counters.get("recurring_truncated", 0) + 1
+            logger.warning(f"Recurring event truncated to {IMPORT_MAX_OCCURRENCES} occurrences")
+            break
+        occurrences += 1
+        if occurrence in excluded:
+            continue
+
+        occurrence_props = dict(props)
+        occurrence_props["DTSTART"] = (dtstart_params, _format_ics(occurrence, dtstart))
+        if duration is not None:
+            end_params, end_value = props["DTEND"]
+            occurrence_props["DTEND"] = (end_params, _format_ics(occurrence + duration, end_value))
+
+        entry = _ics_component_to_entry("VEVENT", occurrence_props)
+        if entry is not None:
+            counters["recurring_occurrences"] = counters.get("recurring_occurrences", 0) + 1
+            yield entry
+
+
+def iter_ics_entries(stream: Iterable[str], counters: Optional[Dict[str, int]] = None) -> Iterator[ImportEntry]:
+    """
+    Lit un fichier ICS en streaming et produit une entrée par VEVENT / VTODO
+
+    Les VEVENT récurrents (RRULE) sont gardés jusqu'à la fin du fichier puis
+    développés en une entrée par occurrence, après lecture des occurrences
+    modifiées (RECURRENCE-ID) qui peuvent les suivre. RDATE n'est pas pris en
+    charge.
+
+    Args:
+        stream: Itérable de lignes (fichier texte ouvert, par exemple)
+        counters: Dict complété avec recurring_series, recurring_occurrences
+            et recurring_truncated
+
+    Yields:
+        Tuples (clé de déduplication, action)
+    """
+    counters = counters if counters is not None else {}
+    kind = None
+    props: Dict[str, Tuple[str, str]] = {}
+    depth = 0
+    recurring: List[Dict[str, Tuple[str, str]]] = []
+    overridden: Dict[str, Set[datetime]] = {}
+
+    for line in _unfold_lines(stream):
+        if line.startswith("BEGIN:"):
+            component = line[6:].strip().upper()
+            if kind is None and component in ("VEVENT", "VTODO"):
+                kind, props, depth = component, {}, 0
+            elif kind is not None:
+                # Sous-composant (VALARM...) : ignoré
+                depth += 1
+            continue
+
+        if line.startswith("END:"):
+            if kind is None:
+                continue
+            if depth:
+                depth -= 1
+                continue
+            try:
+                if kind == "VEVENT" and "RRULE" in props and "DTSTART" in props:
+                    recurring.append(props)
+                else:
+                    if "RECURRENCE-ID" in props:
+                        uid = props.get("UID", ("", ""))[1]
+                        overridden.setdefault(uid, set()).add(_ics_naive(props["RECURRENCE-ID"][1]))
+                    entry = _ics_component_to_entry(kind, props)
+                    if entry is not None:
+                        yield entry
+            except ValueError as e:
+                logger.warning(f"Skipping invalid {kind}: {e}")
+            kind = None
+            continue
+
+        if kind is None or depth or ":" not in line:
+            continue
+
+        name_params, value = line.split(":", 1)
+        name, _, params = name_params.partition(";")
+        name = name.upper()
+        if name == "EXDATE" and name in props:
+            # EXDATE peut être répété : on cumule les valeurs
+            props[name] = (props[name][0], f"{props[name][1]},{value}")
+        else:
+            # Garder la première occurrence de chaque propriété
+            props.setdefault(name, (params, value))
+
+    for series in recurring:
+        counters["recurring_series"] = counters.get("recurring_series", 0) + 1
+        uid = series.get("UID", ("", ""))[1]
+        try:
+            yield from _expand_recurrence(series, overridden.get(uid, set()), counters)
+        except ValueError as e:
+            logger.warning(f"Skipping invalid recurring VEVENT: {e}")
+
+
+# ---------------------------------------------------------------------------
+# Lecture CSV
+# ---------------------------------------------------------------------------
+
+def iter_csv_entries(stream: Iterable[str]) -> Iterator[ImportEntry]:
+    """
+    Lit un fichier CSV en streaming
+
+    Colonnes reconnues : title, date, time, duration_minutes, due_date, priority,
+    description, action (create_event par défaut si une date est présente,
+    create_task sinon), uid (optionnel, sert de clé de déduplication).
+
+    Args:
+        stream: Itérable de lignes (fichier texte ouvert, par exemple)
+
+    Yields:
+        Tuples (clé de déduplication, action)
+    """
+    for row in csv.DictReader(stream):
+        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        title = row.get("title")
+        if not title:
+            continue
+
+        action = row.get("action") or ("create_event" if row.get("date") else "create_task")
+        if action == "create_event":
+            task = {
+                "action": "create_event",
+                "app": "notion",
+                "title": title,
+                "date": row.get("date"),
+                "time": row.get("time") or "00:00",
+                "description": row.get("description", "")
+            }
+            if row.get("duration_minutes", "").isdigit():
+                task["duration_minutes"] = int(row["duration_minutes"])
+        else:
+            task = {
+                "action": "create_task",
+                "app": "notion",
+                "title": title,
+                "due_date": row.get("due_date") or row.get("date") or None,
+                "priority": row.get("priority") or "medium",
+                "description": row.get("description") or None
+            }
+
+        if row.get("uid"):
+            key = f"csv:{row['uid']}"
+        else:
+            key = "csv:" + hashlib.sha1(repr(sorted(task.items())).encode("utf-8")).hexdigest()
+
+        yield key, task
+
+
+def iter_entries(stream: TextIO, filename: str, counters: Optional[Dict[str, int]] = None) -> Iterator[ImportEntry]:
+    """Choisit le lecteur selon l'extension du fichier (counters : voir iter_ics_entries)"""
+    if filename.lower().endswith(".csv"):
+        return iter_csv_entries(stream)
+    return iter_ics_entries(stream, counters)
+
+
+# ---------------------------------------------------------------------------
+# Registre des entrées importées (checkpoint + déduplication)
+# ---------------------------------------------------------------------------
+
+class ImportLedger:
+    """
+    Registre append-only des clés déjà importées
+
+    Une clé est écrite (et flushée) dès que l'action correspondante a réussi, ce
+    qui sert à la fois de checkpoint et de déduplication entre imports. Les clés
+    en cours d'import sont réservées : un doublon dans le même fichier (ou un
+    import simultané) n'est pas exécuté deux fois.
+    """
+
+    def __init__(self, path: str = DEFAULT_LEDGER_PATH):
+        self.path = path
+        self._keys = set()
+        self._in_flight = set()
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._keys.update(line.strip() for line in f if line.strip())
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys or key in self._in_flight
+
+    def reserve(self, key: str) -> bool:
+        """
+        Réserve une clé avant son import
+
+        Returns:
+            False si la clé est déjà importée ou en cours d'import
+        """
+        if key in self:
+            return False
+        self._in_flight.add(key)
+        return True
+
+    def release(self, key: str):
+        """Libère une clé réservée dont l'import a échoué"""
+        self._in_flight.discard(key)
+
+    def add(self, key: str):
+        """Enregistre une clé importée"""
+        self._in_flight.discard(key)
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        self._file.write(key + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Ferme le fichier du registre"""
+        self._file.close()
+
+
+# Instance globale
+_import_ledger = None
+
+
+def get_import_ledger() -> ImportLedger:
+    """Récupère ou crée le registre partagé par les imports de l'API"""
+    global _import_ledger
+
+    if _import_ledger is None:
+        _import_ledger = ImportLedger()
+
+    return _import_ledger
+
+
+# ---------------------------------------------------------------------------
+# Pipeline d'import
+# ---------------------------------------------------------------------------
+
+async def import_entries(
+    entries: Iterable[ImportEntry],
+    ledger: ImportLedger,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    dry_run: bool = False,
+    credentials: Optional[NotionCredentials] = None
+) -> Dict[str, Any]:
+    """
+    Exécute les entrées via l'ActionRunner avec une concurrence bornée
+
+    La file entre le lecteur et les workers est bornée : la mémoire utilisée ne
+    dépend pas de la taille du fichier.
+
+    Args:
+        entries: Itérable de (clé, action)
+        ledger: Registre des entrées déjà importées
+        concurrency: Nombre maximum d'actions Notion simultanées
+        dry_run: Si True, compte les entrées sans rien exécuter
+        credentials: Identifiants Notion du tenant (défaut : environnement)
+
+    Returns:
+        Dict avec les compteurs imported / skipped / failed et les premières erreurs
+    """
+    from action_runner import get_action_runner
+
+    stats = {"imported": 0, "skipped": 0, "failed": 0, "errors": []}
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    action_runner = None if dry_run else get_action_runner()
+    # Dry run : rien n'est réservé, les doublons du fichier sont comptés ici
+    seen = set()
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            key, task = item
+            try:
+                try:
+                    results = await action_runner.execute_tasks({"tasks": [task]}, credentials)
+                except CircuitOpenError as e:
+                    # Notion coupé : l'entrée échoue, un nouvel import la reprendra
+                    results = [ActionResult(action=task["action"], app="notion", status="error", message=str(e))]
+                result: ActionResult = results[0]
+                if result.status == "success":
+                    ledger.add(key)
+                    stats["imported"] += 1
+                else:
+                    ledger.release(key)
+                    stats["failed"] += 1
+                    if len(stats["errors"]) < 20:
+                        stats["errors"].append({"key": key, "message": result.message})
+            except BaseException:
+                ledger.release(key)
+                raise
+            finally:
+                queue.task_done()
+
+    workers = [] if dry_run else [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+    try:
+        for key, task in entries:
+            if credentials is not None:
+                # Registre partagé : une même entrée peut être importée par plusieurs étudiants
+                key = f"{credentials.tenant_id}:{key}"
+            if dry_run:
+                if key in ledger or key in seen:
+                    stats["skipped"] += 1
+                else:
+                    seen.add(key)
+                    stats["imported"] += 1
+                continue
+            if not ledger.reserve(key):
+                stats["skipped"] += 1
+                continue
+            try:
+                await queue.put((key, task))
+            except BaseException:
+                ledger.release(key)
+                raise
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        if workers:
+            await asyncio.gather(*workers)
+
+    logger.info(
+        f"Import finished: {stats['imported']} imported, "
+        f"{stats['skipped']} skipped, {stats['failed']} failed"
+    )
+    return stats
+
+
+async def import_file(
+    path: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    ledger_path: str = DEFAULT_LEDGER_PATH,
+    dry_run: bool = False
+) -> Dict[str, Any]:
+    """Importe un fichier ICS ou CSV depuis le disque"""
+    ledger = ImportLedger(ledger_path)
+    counters: Dict[str, int] = {}
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            stats = await import_entries(iter_entries(f, path, counters), ledger, concurrency, dry_run)
+        stats.update(counters)
+        return stats
+    finally:
+        ledger.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from dotenv import load_dotenv
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Importe un calendrier ICS/CSV dans Notion")
+    parser.add_argument("path", help="Fichier .ics ou .csv")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Nombre d'actions Notion simultanées")
+    parser.add_argument("--ledger", default=DEFAULT_LEDGER_PATH,
+                        help="Registre des entrées déjà importées")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Compte les entrées sans rien créer")
+    args = parser.parse_args()
+
+    async def run_cli() -> Dict[str, Any]:
+        from actions.notion import get_notion_pool
+        try:
+            return await import_file(args.path, args.concurrency, args.ledger, args.dry_run)
+        finally:
+            await get_notion_pool().close()
+
+    summary = asyncio.run(run_cli())
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
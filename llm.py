@@ -1,40 +1,170 @@
 import os
 import json
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, List, Optional
 import logging
 
+import requests
+
+from resilience import Deadline, DeadlineExceeded, CircuitOpenError, get_circuit_breaker
+from admission import AdmissionRejected
+
 logger = logging.getLogger(__name__)
 
+# Timeout maximal d'un appel LLM (réduit au budget restant de la requête)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+
+# Backend de parsing : "openrouter" (API distante), "local" (modèle GGUF chargé
+# dans le processus) ou "local_server" (serveur llama.cpp sur la machine)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openrouter")
+
+SYSTEM_PROMPT = """Tu es un assistant qui convertit des requêtes en langage naturel en JSON structuré.
+            
+Les actions possibles sont:
+- create_event (Notion): nécessite title, date (YYYY-MM-DD), time (HH:MM), duration_minutes (optionnel)
+- create_page (Notion): nécessite title, content (optionnel)
+- create_task (Notion): nécessite title, due_date (optionnel), priority (low/medium/high)
+
+Réponds UNIQUEMENT avec un JSON valide au format:
+{
+  "tasks": [
+    {
+      "action": "create_event",
+      "app": "notion",
+      "title": "...",
+      "date": "2025-11-28",
+      "time": "10:00",
+      "duration_minutes": 60
+    }
+  ]
+}
+
+IMPORTANT: Réponds UNIQUEMENT avec le JSON, sans texte avant ou après."""
+
+# Ajouté au prompt système en mode conversation (voir sessions.py)
+SESSION_PROMPT = """Contexte de la conversation en cours :
+{context}
+
+Si l'utilisateur fait référence à une entité déjà créée ("le", "ça", "cet examen"...), utilise sa référence #n.
+Pour déplacer ou renommer un événement existant, utilise l'action update_event avec uniquement les champs modifiés :
+{{"action": "update_event", "app": "notion", "ref": "#1", "time": "16:00"}}"""
+
+# Schéma JSON des tâches, utilisé pour contraindre la génération des backends locaux
+TASKS_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tasks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string", "enum": ["create_event", "create_page", "create_task", "update_event"]},
+                    "app": {"type": "string", "enum": ["notion"]},
+                    "title": {"type": "string"},
+                    "date": {"type": "string", "pattern": "^[0-9]{4}-[0-9]{2}-[0-9]{2}$"},
+                    "time": {"type": "string", "pattern": "^[0-9]{2}:[0-9]{2}$"},
+                    "duration_minutes": {"type": "integer"},
+                    "due_date": {"type": "string", "pattern": "^[0-9]{4}-[0-9]{2}-[0-9]{2}$"},
+                    "priority": {"type": "string", "enum": ["low", "medium", "high"]},
+                    "content": {"type": "string"},
+                    "description": {"type": "string"},
+                    "ref": {"type": "string", "pattern": "^#[0-9]+$"}
+                },
+                "required": ["action", "app"]
+            }
+        }
+    },
+    "required": ["tasks"]
+}
+
+
+def build_messages(query: str, context: Optional[str] = None) -> List[Dict[str, str]]:
+    """Messages envoyés au LLM (prompt système, contexte de session éventuel, requête)"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if context:
+        messages.append({"role": "system", "content": SESSION_PROMPT.format(context=context)})
+    messages.append({"role": "user", "content": query})
+    return messages
+
+
+def clean_json_content(content: str) -> Dict[str, Any]:
+    """Retire un éventuel bloc markdown autour du JSON puis le décode"""
+    content = content.strip()
+    
+    if content.startswith("```json"):
+        content = content[7:-3]
+    elif content.startswith("```"):
+        content = content[3:-3]
+    
+    return json.loads(content.strip())
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    """Une erreur 4xx (hors 429) vient de la requête, pas d'OpenRouter"""
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        return status >= 500 or status == 429
+    return True
+
 
 class LLMParser:
     """Parse les requêtes utilisateur et les convertit en actions structurées"""
     
-    def __init__(self):
+    def __init__(self, backend: str = LLM_BACKEND):
+        self.backend = backend
         self.meta_api_key = os.getenv("META_API_KEY")
         self.meta_model = os.getenv("META_MODEL", "meta-llama/llama-3.1-8b-instruct")
+        self.local_llm = None
         
-        if not self.meta_api_key:
-            raise ValueError("META_API_KEY not found in environment variables")
+        if backend == "openrouter":
+            if not self.meta_api_key:
+                raise ValueError("META_API_KEY not found in environment variables")
+        elif backend in ("local", "local_server"):
+            from local_llm import get_local_llm
+            self.local_llm = get_local_llm(backend)
+        else:
+            raise ValueError(f"Unknown LLM_BACKEND: {backend}")
+        
+        self.circuit_breaker = get_circuit_breaker("llm", is_failure=_is_upstream_failure)
     
-    async def parse_query(self, query: str) -> Dict[str, Any]:
+    async def parse_query(
+        self,
+        query: str,
+        deadline: Optional[Deadline] = None,
+        context: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
-        Parse une requête utilisateur avec Meta LLaMA et retourne un JSON structuré
+        Parse une requête utilisateur avec le backend configuré et retourne un JSON structuré
         
         Args:
             query: La requête en langage naturel
+            deadline: Échéance de la requête (le timeout de l'appel LLM s'y adapte)
+            context: Résumé compact de la session (entités créées, derniers messages)
             
         Returns:
             Dict contenant les tasks à exécuter
         """
-        return await self._meta_parse(query)
+        if self.local_llm is not None:
+            return await self._local_parse(query, deadline, context)
+        return await self._meta_parse(query, deadline, context)
+    
+    @staticmethod
+    def _post(url: str, headers: Dict[str, str], payload: Dict[str, Any], timeout: float) -> requests.Response:
+        """Appel HTTP bloquant, exécuté hors de la boucle asyncio"""
+        response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+        response.raise_for_status()
+        return response
     
-    async def _meta_parse(self, query: str) -> Dict[str, Any]:
+    async def _meta_parse(
+        self,
+        query: str,
+        deadline: Optional[Deadline] = None,
+        context: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
         Parse avec Meta LLaMA via OpenRouter (API REST)
         """
         try:
-            import requests
-            
             # API REST OpenRouter
             url = "https://openrouter.ai/api/v1/chat/completions"
             
@@ -45,40 +175,24 @@ class LLMParser:
                 "X-Title": "Assistant Agent IA"
             }
             
-            system_prompt = """Tu es un assistant qui convertit des requêtes en langage naturel en JSON structuré.
-            
-Les actions possibles sont:
-- create_event (Notion): nécessite title, date (YYYY-MM-DD), time (HH:MM), duration_minutes (optionnel)
-- create_page (Notion): nécessite title, content (optionnel)
-- create_task (Notion): nécessite title, due_date (optionnel), priority (low/medium/high)
-
-Réponds UNIQUEMENT avec un JSON valide au format:
-{
-  "tasks": [
-    {
-      "action": "create_event",
-      "app": "notion",
-      "title": "...",
-      "date": "2025-11-28",
-      "time": "10:00",
-      "duration_minutes": 60
-    }
-  ]
-}
-
-IMPORTANT: Réponds UNIQUEMENT avec le JSON, sans texte avant ou après."""
-            
             payload = {
                 "model": self.meta_model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
-                ],
+                "messages": build_messages(query, context),
                 "temperature": 0.3
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()
+            timeout = deadline.budget(LLM_TIMEOUT) if deadline else LLM_TIMEOUT
+            
+            async def post() -> requests.Response:
+                try:
+                    return await asyncio.to_thread(self._post, url, headers, payload, timeout)
+                except requests.exceptions.Timeout:
+                    if timeout < LLM_TIMEOUT:
+                        # Timeout réduit par le budget de l'appelant : neutre pour le breaker
+                        raise DeadlineExceeded("Délai dépassé pendant l'appel au LLM")
+                    raise
+            
+            response = await self.circuit_breaker.call(post)
             
             result = response.json()
             content = result['choices'][0]['message']['content'].strip()
@@ -86,19 +200,51 @@ IMPORTANT: Réponds UNIQUEMENT avec le JSON, sans texte avant ou après."""
             logger.info(f"✅ Meta LLaMA response received")
             logger.info(f"Raw response: {content[:200]}...")
             
-            # Nettoyer le JSON si nécessaire
-            if content.startswith("```json"):
-                content = content[7:-3]
-            elif content.startswith("```"):
-                content = content[3:-3]
-            
-            content = content.strip()
-            
-            return json.loads(content)
+            return clean_json_content(content)
             
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
             logger.error(f"Meta LLaMA parsing error: {e}")
             raise Exception(f"Failed to parse query with Meta LLaMA: {str(e)}")
+    
+    async def _local_parse(
+        self,
+        query: str,
+        deadline: Optional[Deadline] = None,
+        context: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Parse avec le modèle local (sortie contrainte par TASKS_JSON_SCHEMA)
+        """
+        try:
+            timeout = deadline.budget(LLM_TIMEOUT) if deadline else LLM_TIMEOUT
+            # File du modèle pleine : rejet avant le circuit breaker (surcharge, pas panne)
+            self.local_llm.check_capacity()
+            
+            async def complete() -> str:
+                try:
+                    return await self.local_llm.complete(query, timeout, context)
+                except asyncio.TimeoutError:
+                    if timeout < LLM_TIMEOUT:
+                        # Timeout réduit par le budget de l'appelant : neutre pour le breaker
+                        raise DeadlineExceeded("Délai dépassé pendant l'appel au LLM local")
+                    raise
+            
+            try:
+                content = await self.circuit_breaker.call(complete)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Le LLM local n'a pas répondu en {timeout:.1f}s")
+            
+            logger.info(f"Raw local response: {content[:200]}...")
+            
+            return clean_json_content(content)
+            
+        except (CircuitOpenError, DeadlineExceeded, AdmissionRejected):
+            raise
+        except Exception as e:
+            logger.error(f"Local LLM parsing error: {e}")
+            raise Exception(f"Failed to parse query with local LLM: {str(e)}")
 
 
 # Instance globale
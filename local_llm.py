@@ -0,0 +1,236 @@
+"""
+Backends LLM locaux (CPU, sans appel sortant)
+
+- "local" : modèle GGUF chargé une seule fois dans le processus (llama-cpp-python).
+  Les requêtes d'un lot sont générées l'une après l'autre : il n'y a pas de
+  décodage par lots, seulement la déduplication et le cache du préfixe
+  (prompt système commun à toutes les requêtes).
+- "local_server" : serveur llama.cpp (llama-server) sur la machine. Les requêtes
+  d'un lot lui sont envoyées en parallèle et il les décode réellement par lots
+  (--parallel, continuous batching).
+
+Les appels concurrents à parse_query sont regroupés en micro-lots par le
+MicroBatcher : les requêtes identiques d'un même lot ne sont générées qu'une
+fois, les requêtes abandonnées (délai dépassé) ne sont pas générées, et la file
+d'attente est bornée (LOCAL_LLM_MAX_PENDING). La sortie est contrainte par le
+schéma JSON des tâches (TASKS_JSON_SCHEMA).
+"""
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import requests
+
+from llm import TASKS_JSON_SCHEMA, LLM_TIMEOUT, build_messages
+from admission import AdmissionRejected
+from resilience import SharedCallFailed
+
+logger = logging.getLogger(__name__)
+
+# Une requête à générer : (requête utilisateur, contexte de session éventuel)
+Prompt = Tuple[str, Optional[str]]
+
+LOCAL_LLM_MODEL_PATH = os.getenv("LOCAL_LLM_MODEL_PATH", "models/model.gguf")
+LOCAL_LLM_THREADS = int(os.getenv("LOCAL_LLM_THREADS", str(os.cpu_count() or 4)))
+LOCAL_LLM_CONTEXT = int(os.getenv("LOCAL_LLM_CONTEXT", "2048"))
+LOCAL_LLM_MAX_TOKENS = int(os.getenv("LOCAL_LLM_MAX_TOKENS", "512"))
+LOCAL_LLM_SERVER_URL = os.getenv("LOCAL_LLM_SERVER_URL", "http://localhost:8080")
+
+# Micro-batching : taille maximale d'un lot et fenêtre d'attente pour le remplir
+LOCAL_LLM_MAX_BATCH = int(os.getenv("LOCAL_LLM_MAX_BATCH", "8"))
+LOCAL_LLM_BATCH_WINDOW_MS = float(os.getenv("LOCAL_LLM_BATCH_WINDOW_MS", "10"))
+
+# Requêtes en attente de génération au-delà desquelles les nouvelles sont refusées
+LOCAL_LLM_MAX_PENDING = int(os.getenv("LOCAL_LLM_MAX_PENDING", "32"))
+
+
+class LlamaCppModel:
+    """Modèle GGUF chargé dans le processus (llama-cpp-python)"""
+
+    def __init__(self, model_path: str = LOCAL_LLM_MODEL_PATH):
+        try:
+            from llama_cpp import Llama, LlamaRAMCache
+        except ImportError:
+            raise ImportError("llama-cpp-python is required for LLM_BACKEND=local")
+
+        if not os.path.exists(model_path):
+            raise ValueError(f"Local model not found: {model_path}")
+
+        self.model = Llama(
+            model_path=model_path,
+            n_ctx=LOCAL_LLM_CONTEXT,
+            n_threads=LOCAL_LLM_THREADS,
+            verbose=False
+        )
+        # Le prompt système est commun : son évaluation est réutilisée d'une requête à l'autre
+        self.model.set_cache(LlamaRAMCache())
+        logger.info(f"Local model loaded: {model_path}")
+
+    def generate_batch(self, prompts: List[Prompt]) -> List[str]:
+        """
+        Génère les réponses d'un lot (appel bloquant, un seul lot à la fois)
+
+        Les requêtes sont décodées séquentiellement : le temps d'un lot croît
+        linéairement avec sa taille. Pour un vrai décodage par lots, utiliser
+        LLM_BACKEND=local_server.
+        """
+        outputs = []
+        for query, context in prompts:
+            completion = self.model.create_chat_completion(
+                messages=build_messages(query, context),
+                response_format={"type": "json_object", "schema": TASKS_JSON_SCHEMA},
+                temperature=0,
+                max_tokens=LOCAL_LLM_MAX_TOKENS
+            )
+            outputs.append(completion["choices"][0]["message"]["content"])
+        return outputs
+
+
+class LlamaServerModel:
+    """Serveur llama.cpp local (API compatible OpenAI)"""
+
+    def __init__(self, base_url: str = LOCAL_LLM_SERVER_URL):
+        self.url = f"{base_url.rstrip('/')}/v1/chat/completions"
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=LOCAL_LLM_MAX_BATCH)
+
+    def _generate(self, prompt: Prompt) -> str:
+        query, context = prompt
+        response = self.session.post(self.url, json={
+            "messages": build_messages(query, context),
+            "response_format": {"type": "json_object", "schema": TASKS_JSON_SCHEMA},
+            "temperature": 0,
+            "max_tokens": LOCAL_LLM_MAX_TOKENS
+        }, timeout=LLM_TIMEOUT)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def generate_batch(self, prompts: List[Prompt]) -> List[str]:
+        """Envoie le lot en parallèle : le serveur les traite dans un même batch"""
+        return list(self.executor.map(self._generate, prompts))
+
+
+class MicroBatcher:
+    """
+    Regroupe les appels concurrents en lots exécutés par un seul worker
+
+    Un lot part dès qu'il atteint max_batch requêtes ou que la fenêtre
+    window_ms est écoulée depuis la première requête. Une requête dont
+    l'appelant a abandonné (timeout, annulation) est retirée avant génération.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch: int = LOCAL_LLM_MAX_BATCH,
+        window_ms: float = LOCAL_LLM_BATCH_WINDOW_MS,
+        max_pending: int = LOCAL_LLM_MAX_PENDING
+    ):
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.max_pending = max_pending
+        # Durée moyenne d'un lot, pour estimer Retry-After
+        self.avg_batch_seconds = 1.0
+        self._pending: List[Tuple[Prompt, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+
+    def check_capacity(self):
+        """
+        Vérifie qu'une requête de plus peut être mise en attente
+
+        Raises:
+            AdmissionRejected: si LOCAL_LLM_MAX_PENDING requêtes attendent déjà (503)
+        """
+        self._pending = [(prompt, future) for prompt, future in self._pending if not future.done()]
+        if len(self._pending) >= self.max_pending:
+            retry_after = self.avg_batch_seconds * (len(self._pending) / self.max_batch + 1)
+            raise AdmissionRejected("llm", "file du modèle local pleine", 503, retry_after)
+
+    async def complete(self, query: str, timeout: float, context: Optional[str] = None) -> str:
+        """
+        Génère la réponse JSON d'une requête
+
+        L'appelant vérifie la place disponible au préalable (check_capacity).
+
+        Raises:
+            asyncio.TimeoutError: si la réponse n'est pas prête avant timeout
+            SharedCallFailed: si le lot a échoué et que l'erreur a été remise à une autre requête
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Évite l'avertissement "exception never retrieved" si l'appelant a expiré
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append(((query, context), future))
+
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush(loop, 0)
+        elif self._flush_handle is None:
+            self._schedule_flush(loop, self.window)
+
+        # Timeout ou annulation : wait_for annule la future, la requête ne sera pas générée
+        return await asyncio.wait_for(future, timeout)
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(delay, lambda: asyncio.ensure_future(self._flush()))
+
+    async def _flush(self):
+        self._flush_handle = None
+        if self._lock.locked():
+            # Un lot est en cours : le suivant partira dès sa fin
+            return
+
+        outputs = None
+        async with self._lock:
+            # Les requêtes abandonnées par leur appelant ne sont pas générées
+            self._pending = [(prompt, future) for prompt, future in self._pending if not future.done()]
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+
+            # Requêtes identiques du lot : une seule génération
+            unique = list(dict.fromkeys(prompt for prompt, _ in batch))
+            if unique:
+                start = time.monotonic()
+                try:
+                    outputs = await asyncio.to_thread(self.model.generate_batch, unique)
+                except Exception as e:
+                    # Une seule requête reçoit l'erreur (un seul échec pour le circuit breaker)
+                    error = e
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(error)
+                            error = SharedCallFailed(f"Échec du lot du modèle local : {e}")
+                            error.__cause__ = e
+                else:
+                    self.avg_batch_seconds = 0.8 * self.avg_batch_seconds + 0.2 * (time.monotonic() - start)
+
+        if self._pending:
+            self._schedule_flush(asyncio.get_running_loop(), 0)
+        if outputs is None:
+            return
+
+        by_prompt = dict(zip(unique, outputs))
+        logger.debug(f"Local batch of {len(batch)} request(s), {len(unique)} generation(s)")
+        for prompt, future in batch:
+            if not future.done():
+                future.set_result(by_prompt[prompt])
+
+
+# Instance globale
+_local_llm = None
+
+
+def get_local_llm(backend: str = "local") -> MicroBatcher:
+    """Récupère ou crée le modèle local (chargé une seule fois par processus)"""
+    global _local_llm
+
+    if _local_llm is None:
+        model = LlamaServerModel() if backend == "local_server" else LlamaCppModel()
+        _local_llm = MicroBatcher(model)
+
+    return _local_llm
@@ -1,13 +1,25 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
+import io
+import asyncio
 import logging
+import json
 import time
 from datetime import datetime
+from typing import Optional
 
 from models import UserQuery, AgentResponse, ActionResult
 from llm import get_llm_parser
 from action_runner import get_action_runner
+from serialization import FastJSONResponse, shape_payload, render_response
+from actions.notion import NotionCredentials, get_notion_pool
+from resilience import Deadline, DeadlineExceeded, CircuitOpenError, get_circuit_breakers
+from admission import AdmissionRejected, get_stage_limiter, get_stage_limiters, is_trusted_frontend, retry_after_header
+from history import get_history_store
+from sessions import get_session_store, strip_page_ids
+from importer import iter_entries, import_entries, get_import_ledger, DEFAULT_CONCURRENCY
 
 # Configuration du logging
 logging.basicConfig(
@@ -30,7 +42,8 @@ load_dotenv()
 app = FastAPI(
     title="Assistant Étudiant IA",
     description="API pour gérer automatiquement Google Calendar et Notion via langage naturel",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse
 )
 
 # Configuration CORS pour permettre l'accès depuis l'interface web
@@ -43,6 +56,106 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    """Démarre l'écriture de l'historique et la fermeture des clients Notion inactifs"""
+    get_history_store().start()
+    get_notion_pool().start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Écrit l'historique en attente et ferme proprement les clients Notion"""
+    await get_history_store().stop()
+    await get_notion_pool().close()
+
+
+def get_notion_credentials(request: Request) -> Optional[NotionCredentials]:
+    """
+    Sélectionne le tenant Notion à partir de la requête
+    
+    En-têtes X-Notion-Token et X-Notion-Database-Id ; sans eux, les
+    identifiants par défaut (variables d'environnement) sont utilisés.
+    """
+    token = request.headers.get("x-notion-token")
+    if not token:
+        return None
+    return NotionCredentials(
+        api_key=token,
+        database_id=request.headers.get("x-notion-database-id")
+    )
+
+
+def get_deadline(request: Request) -> Deadline:
+    """Échéance de la requête (en-tête X-Request-Timeout en secondes, sinon défaut)"""
+    return Deadline.from_header(request.headers.get("x-request-timeout"))
+
+
+def get_client_id(request: Request, credentials: Optional[NotionCredentials]) -> str:
+    """
+    Clé d'équité du contrôle d'admission
+    
+    Par ordre de priorité : en-tête X-Client-Id s'il vient d'un front-end de
+    confiance (ADMISSION_TRUSTED_PROXIES ou ADMISSION_FRONTEND_SECRET), tenant
+    Notion, adresse IP. Un appelant quelconque ne peut donc pas se donner une
+    nouvelle clé à chaque requête pour contourner la limite par client.
+    """
+    host = request.client.host if request.client else None
+    client_id = request.headers.get("x-client-id")
+    if client_id and is_trusted_frontend(host, request.headers.get("x-frontend-secret")):
+        return "client:" + client_id[:128]
+    if credentials:
+        return "tenant:" + credentials.tenant_id
+    return "ip:" + (host or "anonymous")
+
+
+def record_history(
+    query: str,
+    parsed_tasks: Optional[dict],
+    results: list,
+    start_time: float,
+    credentials: Optional[NotionCredentials],
+    error: Optional[str] = None
+):
+    """Ajoute l'exécution à l'historique (non bloquant)"""
+    get_history_store().append(
+        query=query,
+        parsed_tasks=parsed_tasks,
+        results=[result.model_dump() for result in results],
+        execution_time=time.time() - start_time,
+        tenant=credentials.tenant_id if credentials else None,
+        error=error
+    )
+
+
+def get_session(query: UserQuery, credentials: Optional[NotionCredentials]):
+    """Session de conversation de la requête (None en mode sans état)"""
+    if not query.session_id:
+        return None
+    tenant = credentials.tenant_id if credentials else None
+    return get_session_store().get(query.session_id, tenant)
+
+
+def upstream_error(e: Exception) -> HTTPException:
+    """Convertit une erreur de dépendance (circuit ouvert, délai dépassé) en réponse HTTP"""
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, int(e.retry_after)))}
+        )
+    return HTTPException(status_code=504, detail=str(e))
+
+
+def overload_error(e: AdmissionRejected) -> HTTPException:
+    """Convertit un rejet du contrôle d'admission en 429/503 avec Retry-After"""
+    return HTTPException(
+        status_code=e.status_code,
+        detail=str(e),
+        headers={"Retry-After": retry_after_header(e)}
+    )
+
+
 @app.get("/")
 async def root():
     """Route de base pour vérifier que l'API fonctionne"""
@@ -51,6 +164,9 @@ async def root():
         "status": "running",
         "endpoints": {
             "run": "/run - Exécuter une requête en langage naturel",
+            "run_stream": "/run/stream - Exécuter une requête avec résultats progressifs (NDJSON)",
+            "import": "/import - Importer un calendrier ICS/CSV sans passer par le LLM",
+            "history": "/history - Historique des exécutions",
             "health": "/health - Vérifier l'état de l'API",
             "docs": "/docs - Documentation interactive"
         }
@@ -60,41 +176,68 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Vérifie l'état de santé de l'API"""
+    breakers = {name: breaker.snapshot() for name, breaker in get_circuit_breakers().items()}
+    degraded = any(snapshot["state"] != "closed" for snapshot in breakers.values())
+    
     return {
-        "status": "healthy",
+        "status": "degraded" if degraded else "healthy",
         "timestamp": datetime.now().isoformat(),
         "services": {
             "llm": "operational",
             "action_runner": "operational"
-        }
+        },
+        "circuit_breakers": breakers,
+        "admission": {name: limiter.snapshot() for name, limiter in get_stage_limiters().items()}
     }
 
 
 @app.post("/run", response_model=AgentResponse)
-async def run_query(query: UserQuery):
+async def run_query(
+    query: UserQuery,
+    request: Request,
+    compact: bool = False,
+    fields: Optional[str] = None
+):
     """
     Endpoint principal - Exécute une requête en langage naturel
     
     Args:
         query: UserQuery contenant la requête utilisateur
+        request: Requête HTTP (en-têtes Accept, X-Request-Timeout, tenant Notion)
+        compact: Si True, ne renvoie que les statuts, identifiants et URLs
+        fields: Champs de premier niveau à renvoyer (ex: "results,execution_time")
         
     Returns:
         AgentResponse avec le JSON parsé et les résultats d'exécution
     """
     start_time = time.time()
+    deadline = get_deadline(request)
+    credentials = get_notion_credentials(request)
+    client_id = get_client_id(request, credentials)
+    session = get_session(query, credentials)
+    parsed_tasks = None
     
     logger.info(f"Received query: {query.query}")
     
     try:
-        # Étape 1: Parser la requête avec le LLM
+        # Étape 1: Parser la requête avec le LLM (avec le résumé de la session éventuelle)
         llm_parser = get_llm_parser()
-        parsed_tasks = await llm_parser.parse_query(query.query)
+        context = session.build_context() if session else None
+        async with get_stage_limiter("llm").slot(client_id, deadline):
+            parsed_tasks = await llm_parser.parse_query(query.query, deadline, context)
+        if session:
+            session.resolve_refs(parsed_tasks)
+        else:
+            strip_page_ids(parsed_tasks)
         
         logger.info(f"Parsed tasks: {parsed_tasks}")
         
         # Étape 2: Exécuter les actions
         action_runner = get_action_runner()
-        results = await action_runner.execute_tasks(parsed_tasks)
+        async with get_stage_limiter("notion").slot(client_id, deadline):
+            results = await action_runner.execute_tasks(parsed_tasks, credentials, deadline)
+        if session:
+            session.record_turn(query.query, parsed_tasks, results)
         
         # Calculer le temps d'exécution
         execution_time = time.time() - start_time
@@ -106,34 +249,223 @@ async def run_query(query: UserQuery):
             query=query.query,
             parsed_tasks=parsed_tasks,
             results=results,
-            execution_time=execution_time
+            execution_time=execution_time,
+            session_id=query.session_id
         )
         
-        return response
+        record_history(query.query, parsed_tasks, results, start_time, credentials)
+        
+        return render_response(
+            request,
+            shape_payload(response.model_dump(), compact=compact, fields=fields)
+        )
         
+    except AdmissionRejected as e:
+        raise overload_error(e)
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.warning(f"Upstream unavailable: {e}")
+        record_history(query.query, parsed_tasks, [], start_time, credentials, error=str(e))
+        raise upstream_error(e)
     except Exception as e:
         logger.error(f"Error processing query: {e}", exc_info=True)
+        record_history(query.query, parsed_tasks, [], start_time, credentials, error=str(e))
         raise HTTPException(
             status_code=500,
             detail=f"Erreur lors du traitement de la requête: {str(e)}"
         )
 
 
+@app.post("/run/stream")
+async def run_query_stream(query: UserQuery, request: Request):
+    """
+    Variante streamée de /run - Renvoie les résultats au fur et à mesure
+    
+    Le parsing a lieu avant l'envoi de la réponse : une surcharge (429/503),
+    une dépendance coupée (503) ou un délai dépassé (504) renvoient un vrai
+    statut HTTP avec Retry-After. Ensuite, chaque ligne de la réponse (NDJSON)
+    est un événement :
+    - {"event": "parsed", "parsed_tasks": {...}}
+    - {"event": "result", "index": 0, "result": {...}}
+    - {"event": "done", "execution_time": 0.45}
+    - {"event": "error", "detail": "..."}
+    
+    Args:
+        query: UserQuery contenant la requête utilisateur
+        request: Requête HTTP (sélection du tenant Notion)
+        
+    Returns:
+        StreamingResponse au format application/x-ndjson
+    """
+    start_time = time.time()
+    credentials = get_notion_credentials(request)
+    deadline = get_deadline(request)
+    client_id = get_client_id(request, credentials)
+    session = get_session(query, credentials)
+    
+    logger.info(f"Received streamed query: {query.query}")
+    
+    try:
+        llm_parser = get_llm_parser()
+        context = session.build_context() if session else None
+        async with get_stage_limiter("llm").slot(client_id, deadline):
+            parsed_tasks = await llm_parser.parse_query(query.query, deadline, context)
+    except AdmissionRejected as e:
+        raise overload_error(e)
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.warning(f"Upstream unavailable: {e}")
+        record_history(query.query, None, [], start_time, credentials, error=str(e))
+        raise upstream_error(e)
+    except Exception as e:
+        logger.error(f"Error parsing streamed query: {e}", exc_info=True)
+        record_history(query.query, None, [], start_time, credentials, error=str(e))
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erreur lors du traitement de la requête: {str(e)}"
+        )
+    
+    if session:
+        session.resolve_refs(parsed_tasks)
+    else:
+        strip_page_ids(parsed_tasks)
+    
+    logger.info(f"Parsed tasks: {parsed_tasks}")
+    
+    async def event_stream():
+        results = []
+        action_results = get_action_runner().iter_tasks(parsed_tasks, credentials, deadline)
+        notion_stage = get_stage_limiter("notion")
+        
+        def record_interrupted(error: str):
+            # Les actions déjà exécutées restent dans l'historique et la session
+            if session and results:
+                session.record_turn(query.query, parsed_tasks, results)
+            record_history(query.query, parsed_tasks, results, start_time, credentials, error=error)
+        
+        try:
+            yield json.dumps({"event": "parsed", "parsed_tasks": parsed_tasks}) + "\n"
+            
+            # Une place Notion par action (iter_tasks produit un résultat par tâche),
+            # libérée avant l'écriture vers le client : un lecteur lent ne la bloque pas
+            for index in range(len(parsed_tasks.get("tasks", []))):
+                async with notion_stage.slot(client_id, deadline):
+                    result = await action_results.__anext__()
+                results.append(result)
+                yield json.dumps({
+                    "event": "result",
+                    "index": index,
+                    "result": result.model_dump()
+                }) + "\n"
+            
+            if session:
+                session.record_turn(query.query, parsed_tasks, results)
+            
+            execution_time = time.time() - start_time
+            logger.info(f"Streamed execution completed in {execution_time:.2f}s")
+            record_history(query.query, parsed_tasks, results, start_time, credentials)
+            yield json.dumps({"event": "done", "execution_time": execution_time}) + "\n"
+            
+        except AdmissionRejected as e:
+            if results:
+                record_interrupted(str(e))
+            yield json.dumps({
+                "event": "error",
+                "detail": str(e),
+                "status_code": e.status_code,
+                "retry_after": int(retry_after_header(e))
+            }) + "\n"
+        except Exception as e:
+            logger.error(f"Error processing streamed query: {e}", exc_info=True)
+            record_interrupted(str(e))
+            yield json.dumps({
+                "event": "error",
+                "detail": f"Erreur lors du traitement de la requête: {str(e)}"
+            }) + "\n"
+        finally:
+            await action_results.aclose()
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+@app.get("/history")
+async def get_history(
+    request: Request,
+    limit: int = 50,
+    cursor: Optional[int] = None,
+    status: Optional[str] = None,
+    action: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    details: bool = False
+):
+    """
+    Historique des exécutions de /run du tenant appelant, du plus récent au plus ancien
+    
+    Le tenant est déduit de l'en-tête X-Notion-Token (sans en-tête : identifiants
+    par défaut) ; l'historique des autres tenants n'est jamais renvoyé.
+    
+    Args:
+        request: Requête HTTP (sélection du tenant Notion)
+        limit: Taille de la page (200 maximum)
+        cursor: next_cursor renvoyé par la page précédente
+        status: success, partial ou error
+        action: Type d'action (create_event, create_page, create_task)
+        since / until: Bornes de date (ISO 8601)
+        details: Inclut parsed_tasks et les résultats de chaque exécution
+        
+    Returns:
+        Dict avec "items" et "next_cursor"
+    """
+    credentials = get_notion_credentials(request)
+    
+    try:
+        return await asyncio.to_thread(
+            get_history_store().query,
+            limit=max(1, min(limit, 200)),
+            cursor=cursor,
+            status=status,
+            action=action,
+            since=since.timestamp() if since else None,
+            until=until.timestamp() if until else None,
+            tenant=credentials.tenant_id if credentials else None,
+            include_details=details
+        )
+        
+    except Exception as e:
+        logger.error(f"Error reading history: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erreur lors de la lecture de l'historique: {str(e)}"
+        )
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str, request: Request):
+    """Termine une conversation (le prochain /run avec cet ID repart de zéro)"""
+    credentials = get_notion_credentials(request)
+    tenant = credentials.tenant_id if credentials else None
+    return {"session_id": session_id, "deleted": get_session_store().delete(session_id, tenant)}
+
+
 @app.post("/parse", response_model=dict)
-async def parse_only(query: UserQuery):
+async def parse_only(query: UserQuery, request: Request):
     """
     Endpoint pour parser uniquement (sans exécution)
     Utile pour tester le parsing du LLM
     
     Args:
         query: UserQuery contenant la requête utilisateur
+        request: Requête HTTP (en-tête X-Request-Timeout)
         
     Returns:
         JSON parsé
     """
+    deadline = get_deadline(request)
+    client_id = get_client_id(request, get_notion_credentials(request))
+    
     try:
         llm_parser = get_llm_parser()
-        parsed_tasks = await llm_parser.parse_query(query.query)
+        async with get_stage_limiter("llm").slot(client_id, deadline):
+            parsed_tasks = await llm_parser.parse_query(query.query, deadline)
         
         return {
             "query": query.query,
@@ -141,6 +473,11 @@ async def parse_only(query: UserQuery):
             "status": "success"
         }
         
+    except AdmissionRejected as e:
+        raise overload_error(e)
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        logger.warning(f"Upstream unavailable: {e}")
+        raise upstream_error(e)
     except Exception as e:
         logger.error(f"Error parsing query: {e}")
         raise HTTPException(
@@ -149,6 +486,54 @@ async def parse_only(query: UserQuery):
         )
 
 
+@app.post("/import")
+async def import_calendar(
+    request: Request,
+    file: UploadFile = File(...),
+    concurrency: int = DEFAULT_CONCURRENCY,
+    dry_run: bool = False
+):
+    """
+    Importe un calendrier ICS ou CSV directement dans Notion (sans LLM)
+    
+    Les entrées déjà importées sont ignorées : relancer un import interrompu
+    reprend là où il s'était arrêté.
+    
+    Args:
+        request: Requête HTTP (sélection du tenant Notion)
+        file: Fichier .ics ou .csv
+        concurrency: Nombre maximum d'actions Notion simultanées
+        dry_run: Si True, compte les entrées sans rien créer
+        
+    Returns:
+        Compteurs imported / skipped / failed (et occurrences des événements récurrents)
+    """
+    start_time = time.time()
+    
+    logger.info(f"Importing calendar file: {file.filename}")
+    
+    try:
+        stream = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+        counters = {}
+        stats = await import_entries(
+            iter_entries(stream, file.filename or "", counters),
+            get_import_ledger(),
+            concurrency=max(1, min(concurrency, 16)),
+            dry_run=dry_run,
+            credentials=get_notion_credentials(request)
+        )
+        stats.update(counters)
+        stats["execution_time"] = time.time() - start_time
+        return stats
+        
+    except Exception as e:
+        logger.error(f"Error importing calendar: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erreur lors de l'import: {str(e)}"
+        )
+
+
 if __name__ == "__main__":
     import uvicorn
     
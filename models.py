@@ -45,6 +45,9 @@ class TaskList(BaseModel):
 class UserQuery(BaseModel):
     """Requête utilisateur"""
     query: str = Field(..., description="Instruction en langage naturel")
+    session_id: Optional[str] = Field(
+        None, max_length=128, description="Identifiant de conversation (mode session)"
+    )
 
 
 class ActionResult(BaseModel):
@@ -62,3 +65,4 @@ class AgentResponse(BaseModel):
     parsed_tasks: dict
     results: List[ActionResult]
     execution_time: float
+    session_id: Optional[str] = None
@@ -0,0 +1,225 @@
+"""
+Résilience face aux dépendances externes (OpenRouter, Notion)
+
+- Deadline : budget de temps d'une requête, propagé à chaque appel externe
+- CircuitBreaker : coupe les appels vers une dépendance dégradée et échoue
+  immédiatement tant qu'elle n'a pas été sondée avec succès
+"""
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Budget par défaut et maximum d'une requête (secondes)
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "25"))
+MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT", "60"))
+# Budget minimal accepté : en dessous, aucun appel externe ne peut aboutir
+MIN_REQUEST_TIMEOUT = float(os.getenv("MIN_REQUEST_TIMEOUT", "2"))
+
+# Seuils des circuit breakers
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "10"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+
+class DeadlineExceeded(Exception):
+    """
+    Le budget de temps de la requête est épuisé
+
+    Imputable au délai choisi par l'appelant, pas à la dépendance : neutre
+    pour les circuit breakers.
+    """
+
+
+class SharedCallFailed(Exception):
+    """
+    Échec d'un appel partagé par plusieurs requêtes (lot du modèle local)
+
+    L'erreur d'origine n'est remise qu'à une seule requête, qui la compte comme
+    échec ; pour les autres requêtes du lot, l'échec est neutre.
+    """
+
+
+class CircuitOpenError(Exception):
+    """La dépendance est coupée par son circuit breaker"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Service '{name}' temporairement indisponible")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """Échéance absolue d'une requête"""
+
+    def __init__(self, timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    @classmethod
+    def from_header(cls, value: Optional[str]) -> "Deadline":
+        """
+        Construit l'échéance depuis l'en-tête X-Request-Timeout (secondes)
+
+        Valeur absente ou invalide : budget par défaut. Toujours borné entre
+        MIN_REQUEST_TIMEOUT et MAX_REQUEST_TIMEOUT.
+        """
+        try:
+            timeout = float(value) if value else DEFAULT_REQUEST_TIMEOUT
+        except ValueError:
+            timeout = DEFAULT_REQUEST_TIMEOUT
+        return cls(max(MIN_REQUEST_TIMEOUT, min(timeout, MAX_REQUEST_TIMEOUT)))
+
+    def remaining(self) -> float:
+        """Temps restant en secondes (jamais négatif)"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget(self, cap: Optional[float] = None) -> float:
+        """
+        Timeout à appliquer au prochain appel externe
+
+        Args:
+            cap: Timeout maximal propre à l'appel
+
+        Raises:
+            DeadlineExceeded: si le budget est déjà épuisé
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Délai de {self.timeout:.1f}s dépassé")
+        return remaining if cap is None else min(remaining, cap)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker à trois états
+
+    - closed : les appels passent ; les échecs (et appels trop lents) consécutifs
+      sont comptés
+    - open : après failure_threshold échecs, les appels échouent immédiatement
+      pendant reset_timeout secondes
+    - half_open : un seul appel de sonde est autorisé ; son succès referme le
+      circuit, son échec le rouvre
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+        is_failure: Optional[Callable[[BaseException], bool]] = None
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure or (lambda exc: True)
+
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        """
+        Vérifie que l'appel est autorisé
+
+        Raises:
+            CircuitOpenError: si le circuit est ouvert (ou qu'une sonde est en cours)
+        """
+        if self.state == "open":
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+            self.state = "half_open"
+            logger.info(f"Circuit '{self.name}' half-open, probing")
+
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._probe_in_flight = True
+
+    def record_success(self, latency: float):
+        """Enregistre un appel réussi (compté comme échec s'il est trop lent)"""
+        if latency > self.slow_call_seconds:
+            self._on_failure()
+            return
+        if self.state != "closed":
+            logger.info(f"Circuit '{self.name}' closed")
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self, exc: BaseException):
+        """Enregistre un appel en échec (si l'erreur est imputable à la dépendance)"""
+        if not self.is_failure(exc):
+            # Erreur côté client (requête invalide...) : la dépendance répond normalement
+            self.record_success(0.0)
+            return
+        self._on_failure()
+
+    def _on_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit '{self.name}' opened after {self.failures} failure(s)")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    async def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Exécute une coroutine sous la protection du circuit breaker
+
+        Un DeadlineExceeded (timeout réduit par le budget de l'appelant) ou un
+        SharedCallFailed (échec déjà compté) n'est compté ni comme succès ni
+        comme échec.
+        """
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except (DeadlineExceeded, SharedCallFailed):
+            self._probe_in_flight = False
+            raise
+        except Exception as exc:
+            self.record_failure(exc)
+            raise
+        except BaseException:
+            # Annulation (client déconnecté) : ni succès ni échec
+            self._probe_in_flight = False
+            raise
+        self.record_success(time.monotonic() - start)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        """État du circuit pour /health"""
+        snapshot = {"state": self.state, "failures": self.failures}
+        if self.state == "open":
+            snapshot["retry_after"] = round(
+                max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1
+            )
+        return snapshot
+
+
+# Instances globales
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """Récupère ou crée le circuit breaker d'une dépendance"""
+    if name not in _circuit_breakers:
+        _circuit_breakers[name] = CircuitBreaker(name, **kwargs)
+    return _circuit_breakers[name]
+
+
+def get_circuit_breakers() -> Dict[str, CircuitBreaker]:
+    """Tous les circuit breakers enregistrés"""
+    return _circuit_breakers
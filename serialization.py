@@ -0,0 +1,105 @@
+"""
+Sérialisation des réponses de l'API
+
+- JSON via orjson si disponible (repli sur le JSON standard sinon)
+- MessagePack si le client l'accepte (en-tête Accept: application/x-msgpack)
+- Mode compact / sélection de champs pour réduire la taille des réponses
+"""
+from typing import Any, Dict, List, Optional
+import logging
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+# Clés de details conservées en mode compact (identifiants, URLs)
+COMPACT_DETAIL_KEYS = ("page_id", "page_url", "task_id", "task_url")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encodée avec orjson quand il est installé"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MsgPackResponse(Response):
+    """Réponse encodée en MessagePack"""
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, use_bin_type=True)
+
+
+def compact_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Réduit chaque résultat d'action à son statut, ses identifiants et ses URLs"""
+    compact = []
+    for result in results:
+        item = {
+            "action": result.get("action"),
+            "app": result.get("app"),
+            "status": result.get("status")
+        }
+        details = result.get("details") or {}
+        for key in COMPACT_DETAIL_KEYS:
+            if details.get(key):
+                item[key] = details[key]
+        compact.append(item)
+    return compact
+
+
+def shape_payload(
+    payload: Dict[str, Any],
+    compact: bool = False,
+    fields: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Applique le mode compact et/ou la sélection de champs à une réponse
+
+    Args:
+        payload: Réponse sous forme de dict (AgentResponse.model_dump())
+        compact: Si True, supprime parsed_tasks et réduit les résultats
+        fields: Liste de champs de premier niveau séparés par des virgules
+
+    Returns:
+        Dict prêt à être sérialisé
+    """
+    if compact:
+        payload = {key: value for key, value in payload.items() if key != "parsed_tasks"}
+        if "results" in payload:
+            payload["results"] = compact_results(payload["results"])
+
+    if fields:
+        wanted = {field.strip() for field in fields.split(",") if field.strip()}
+        payload = {key: value for key, value in payload.items() if key in wanted}
+
+    return payload
+
+
+def render_response(request: Request, payload: Dict[str, Any]) -> Response:
+    """
+    Choisit MessagePack ou JSON selon l'en-tête Accept du client
+
+    Vary: Accept empêche un cache partagé de servir un format à un client qui
+    a demandé l'autre.
+    """
+    accept = request.headers.get("accept", "")
+    headers = {"Vary": "Accept"}
+    if msgpack is not None and MSGPACK_MEDIA_TYPE in accept:
+        return MsgPackResponse(payload, headers=headers)
+    return FastJSONResponse(payload, headers=headers)
@@ -0,0 +1,211 @@
+"""
+Sessions de conversation pour /run
+
+Chaque session garde côté serveur un résumé compact et structuré :
+- les entités créées (référencées #1, #2...) avec leur ID Notion
+- les derniers messages de l'utilisateur
+
+Seul ce résumé, plafonné par un budget de tokens, est envoyé au LLM : la taille
+du prompt reste stable quelle que soit la longueur de la conversation. Les
+sessions sont évincées par LRU et après une durée d'inactivité.
+"""
+import os
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from models import ActionResult
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "10000"))
+SESSION_CONTEXT_TOKENS = int(os.getenv("SESSION_CONTEXT_TOKENS", "300"))
+SESSION_MAX_ENTITIES = int(os.getenv("SESSION_MAX_ENTITIES", "20"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "3"))
+
+# Longueur maximale d'un message conservé dans le résumé
+TURN_MAX_CHARS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimation grossière du nombre de tokens (~4 caractères par token)"""
+    return len(text) // 4 + 1
+
+
+def strip_page_ids(parsed_tasks: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Retire les page_id (et entity_action) produits par le modèle
+
+    Sans cela, une requête pourrait faire modifier n'importe quelle page
+    accessible avec le token du tenant. Le page_id n'est renseigné que par
+    SessionState.resolve_refs, à partir des entités de la session.
+    """
+    for task in parsed_tasks.get("tasks", []):
+        if isinstance(task, dict):
+            task.pop("page_id", None)
+            task.pop("entity_action", None)
+    return parsed_tasks
+
+
+class SessionState:
+    """État compact d'une conversation"""
+
+    def __init__(self):
+        self.entities: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.turns: deque = deque(maxlen=SESSION_MAX_TURNS)
+        self.next_ref = 1
+        self.last_used = time.monotonic()
+
+    def build_context(self, token_budget: int = SESSION_CONTEXT_TOKENS) -> Optional[str]:
+        """
+        Résumé de la session pour le LLM, plafonné à token_budget
+
+        Les entités et messages les plus récents sont prioritaires.
+        """
+        lines: List[str] = []
+        used = 0
+
+        entity_lines = [self._describe(ref, entity) for ref, entity in reversed(self.entities.items())]
+        turn_lines = [f"- {turn}" for turn in reversed(self.turns)]
+
+        for header, items in (("Entités créées :", entity_lines), ("Derniers messages :", turn_lines)):
+            section = []
+            for line in items:
+                cost = estimate_tokens(line)
+                if used + cost > token_budget:
+                    break
+                section.append(line)
+                used += cost
+            if section:
+                lines.append(header)
+                lines.extend(section)
+
+        return "\n".join(lines) or None
+
+    @staticmethod
+    def _describe(ref: str, entity: Dict[str, Any]) -> str:
+        parts = [ref, entity["action"].replace("create_", ""), f"\"{entity['title']}\""]
+        if entity.get("date"):
+            parts.append(entity["date"])
+        if entity.get("time"):
+            parts.append(entity["time"])
+        return " ".join(parts)
+
+    def resolve_refs(self, parsed_tasks: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Remplace les références #n des actions par l'ID Notion de l'entité
+
+        Seules les entités créées dans la session peuvent être ciblées : un
+        page_id fourni par le modèle est toujours ignoré. L'action qui a créé
+        l'entité est copiée dans entity_action (le titre d'un événement garde
+        son préfixe). Un update_event qui ne change que la date (ou l'heure)
+        garde l'heure (ou la date) de l'entité.
+        """
+        strip_page_ids(parsed_tasks)
+        for task in parsed_tasks.get("tasks", []):
+            if not isinstance(task, dict):
+                continue
+            ref = task.get("ref")
+            if ref is None and task.get("action") == "update_event" and self.entities:
+                # "déplace-le" sans référence explicite : dernière entité créée
+                ref = next(reversed(self.entities))
+            entity = self.entities.get(ref) if isinstance(ref, str) else None
+            if entity is None:
+                continue
+            task["page_id"] = entity["page_id"]
+            task["entity_action"] = entity["action"]
+            if task.get("action") == "update_event":
+                if task.get("time") and not task.get("date"):
+                    task["date"] = entity.get("date")
+                if task.get("date") and not task.get("time") and entity.get("time"):
+                    task["time"] = entity["time"]
+        return parsed_tasks
+
+    def record_turn(self, query: str, parsed_tasks: Dict[str, Any], results: List[ActionResult]):
+        """Met à jour le résumé après une exécution"""
+        self.turns.append(query[:TURN_MAX_CHARS])
+
+        tasks = [task for task in parsed_tasks.get("tasks", []) if isinstance(task, dict)]
+        for task, result in zip(tasks, results):
+            if result.status != "success":
+                continue
+            details = result.details or {}
+            page_id = details.get("page_id") or details.get("task_id")
+
+            if task.get("action", "").startswith("create_") and page_id:
+                ref = f"#{self.next_ref}"
+                self.next_ref += 1
+                self.entities[ref] = {
+                    "action": task["action"],
+                    "title": str(task.get("title", ""))[:80],
+                    "date": task.get("date") or task.get("due_date"),
+                    "time": task.get("time"),
+                    "page_id": page_id
+                }
+                while len(self.entities) > SESSION_MAX_ENTITIES:
+                    self.entities.popitem(last=False)
+
+            elif task.get("action") == "update_event":
+                for entity in self.entities.values():
+                    if entity["page_id"] == task.get("page_id"):
+                        for field in ("title", "date", "time"):
+                            if task.get(field):
+                                entity[field] = task[field]
+
+
+class SessionStore:
+    """Sessions en mémoire avec éviction LRU et expiration"""
+
+    def __init__(self, max_count: int = SESSION_MAX_COUNT, ttl: float = SESSION_TTL):
+        self.max_count = max_count
+        self.ttl = ttl
+        self._sessions: "OrderedDict[Tuple[Optional[str], str], SessionState]" = OrderedDict()
+
+    def get(self, session_id: str, tenant: Optional[str] = None) -> SessionState:
+        """Récupère (ou crée) la session, propre à chaque tenant Notion"""
+        key = (tenant, session_id)
+        now = time.monotonic()
+
+        session = self._sessions.get(key)
+        if session is not None and now - session.last_used > self.ttl:
+            session = None
+        if session is None:
+            session = SessionState()
+            self._sessions[key] = session
+
+        session.last_used = now
+        self._sessions.move_to_end(key)
+        self._evict(now)
+        return session
+
+    def delete(self, session_id: str, tenant: Optional[str] = None) -> bool:
+        """Supprime une session (nouvelle conversation)"""
+        return self._sessions.pop((tenant, session_id), None) is not None
+
+    def _evict(self, now: float):
+        # Les sessions les moins récemment utilisées sont en tête
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_count or now - session.last_used > self.ttl:
+                self._sessions.popitem(last=False)
+            else:
+                break
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+# Instance globale
+_session_store = None
+
+
+def get_session_store() -> SessionStore:
+    """Récupère ou crée le stockage des sessions"""
+    global _session_store
+
+    if _session_store is None:
+        _session_store = SessionStore()
+
+    return _session_store
@@ -1,6 +1,9 @@
+import os
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import uuid
 from datetime import datetime
 
 # Configuration de la page
@@ -13,6 +16,58 @@ st.set_page_config(
 # URL de l'API FastAPI
 API_URL = "http://localhost:8000"
 
+# Timeouts (connexion, lecture) en secondes
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 30
+
+# Nombre maximum de résultats conservés dans l'historique de session
+HISTORY_SIZE = 20
+
+# Secret partagé avec l'API : sans lui, l'API ignore X-Client-Id (sauf proxy de confiance)
+FRONTEND_SECRET = os.getenv("ADMISSION_FRONTEND_SECRET", "")
+
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Session HTTP keep-alive partagée par tous les utilisateurs et tous les reruns"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_data(ttl=10, show_spinner=False)
+def get_api_health() -> bool:
+    """État de santé de l'API, mis en cache pour ne pas l'interroger à chaque rerun"""
+    try:
+        health = get_http_session().get(f"{API_URL}/health", timeout=2)
+        return health.status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
+
+# Historique des résultats de la session courante
+if "history" not in st.session_state:
+    st.session_state["history"] = []
+
+# Conversation côté API : les requêtes suivantes peuvent faire référence aux précédentes
+if "conversation_id" not in st.session_state:
+    st.session_state["conversation_id"] = str(uuid.uuid4())
+
+# Identifiant de l'utilisateur pour l'équité du contrôle d'admission : toutes les
+# requêtes partent de ce serveur, l'adresse IP ne distingue pas les utilisateurs
+if "client_id" not in st.session_state:
+    st.session_state["client_id"] = str(uuid.uuid4())
+
+
+def client_headers() -> dict:
+    """En-têtes propres à l'utilisateur courant"""
+    headers = {"X-Client-Id": st.session_state["client_id"]}
+    if FRONTEND_SECRET:
+        headers["X-Frontend-Secret"] = FRONTEND_SECRET
+    return headers
+
 # Titre de l'application
 st.title("🎓 Assistant Étudiant Automatisé")
 st.markdown("""
@@ -51,72 +106,169 @@ with col1:
         parse_only_btn = st.button("🔍 Parser uniquement", use_container_width=True)
     
     with col_btn3:
-        clear_btn = st.button("🗑️ Effacer", use_container_width=True)
+        clear_btn = st.button("🗑️ Nouvelle conversation", use_container_width=True)
     
     if clear_btn:
+        st.session_state["conversation_id"] = str(uuid.uuid4())
         st.rerun()
 
 st.divider()
 
+def show_api_error(error: requests.exceptions.RequestException):
+    """Affiche une erreur réseau de manière lisible"""
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code in (429, 503):
+        retry_after = response.headers.get("Retry-After", "quelques")
+        st.warning(f"⏳ Service surchargé, réessayez dans {retry_after} secondes")
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        st.error("❌ Impossible de se connecter à l'API. Assurez-vous que le backend est lancé (python main.py)")
+    elif isinstance(error, requests.exceptions.Timeout):
+        st.error("⏱️ Timeout - La requête a pris trop de temps")
+    else:
+        st.error(f"❌ Erreur API: {str(error)}")
+
+
 # Fonction pour appeler l'API
 def call_api(endpoint: str, query: str):
     """Appelle l'API FastAPI"""
     try:
-        response = requests.post(
+        response = get_http_session().post(
             f"{API_URL}/{endpoint}",
             json={"query": query},
-            timeout=30
+            headers=client_headers(),
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
         )
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.ConnectionError:
-        st.error("❌ Impossible de se connecter à l'API. Assurez-vous que le backend est lancé (python main.py)")
-        return None
-    except requests.exceptions.Timeout:
-        st.error("⏱️ Timeout - La requête a pris trop de temps")
-        return None
     except requests.exceptions.RequestException as e:
-        st.error(f"❌ Erreur API: {str(e)}")
+        show_api_error(e)
         return None
 
-# Exécution complète
+
+def stream_api(query: str):
+    """
+    Appelle /run/stream et produit les événements NDJSON au fur et à mesure
+
+    Le timeout de lecture s'applique entre deux événements, pas à la requête entière.
+    """
+    finished = False
+    try:
+        with get_http_session().post(
+            f"{API_URL}/run/stream",
+            json={"query": query, "session_id": st.session_state["conversation_id"]},
+            headers=client_headers(),
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    yield {"event": "error", "detail": "Réponse invalide reçue de l'API"}
+                    return
+                finished = event.get("event") in ("done", "error")
+                yield event
+    except requests.exceptions.RequestException as e:
+        show_api_error(e)
+        return
+
+    if not finished:
+        # Connexion coupée avant l'événement final
+        yield {"event": "error", "detail": "Le flux s'est interrompu avant la fin du traitement"}
+
+
+def status_icon(status: str) -> str:
+    """Couleur associée au statut d'une action"""
+    if status == 'success':
+        return "🟢"
+    elif status == 'mock':
+        return "🟡"
+    return "🔴"
+
+
+def render_action_result(i: int, action_result: dict):
+    """Affiche le résultat d'une action"""
+    with st.expander(f"{status_icon(action_result['status'])} Action {i}: {action_result['action']} sur {action_result['app']}", expanded=True):
+        st.write(f"**Message:** {action_result['message']}")
+
+        if action_result.get('details'):
+            st.write("**Détails:**")
+            st.json(action_result['details'])
+
+
+def render_run_result(result: dict):
+    """Affiche une réponse complète de /run (utilisé aussi pour l'historique)"""
+    st.success(f"✅ Requête traitée en {result['execution_time']:.2f}s")
+
+    tab1, tab2, tab3 = st.tabs(["📊 Résultats", "🔧 JSON Parsé", "📄 Réponse complète"])
+
+    with tab1:
+        st.subheader("Résultats des actions")
+        for i, action_result in enumerate(result['results'], 1):
+            render_action_result(i, action_result)
+
+    with tab2:
+        st.subheader("JSON généré par le LLM")
+        st.json(result['parsed_tasks'])
+
+    with tab3:
+        st.subheader("Réponse complète de l'API")
+        st.json(result)
+
+
+def add_to_history(result: dict):
+    """Ajoute un résultat à l'historique de la session"""
+    history = st.session_state["history"]
+    history.insert(0, {
+        "timestamp": datetime.now().strftime("%H:%M:%S"),
+        "result": result
+    })
+    del history[HISTORY_SIZE:]
+    st.session_state["history_selected"] = None
+
+
+# Exécution complète (résultats affichés au fur et à mesure)
 if execute_btn and user_query:
-    with st.spinner("🔄 Traitement en cours..."):
-        result = call_api("run", user_query)
+    result = {"query": user_query, "parsed_tasks": {}, "results": [], "execution_time": 0.0}
+    completed = False
         
-        if result:
-            # Afficher le temps d'exécution
-            st.success(f"✅ Requête traitée en {result['execution_time']:.2f}s")
-            
-            # Créer des onglets pour les résultats
-            tab1, tab2, tab3 = st.tabs(["📊 Résultats", "🔧 JSON Parsé", "📄 Réponse complète"])
-            
-            with tab1:
-                st.subheader("Résultats des actions")
-                
-                for i, action_result in enumerate(result['results'], 1):
-                    # Déterminer la couleur selon le statut
-                    if action_result['status'] == 'success':
-                        status_color = "🟢"
-                    elif action_result['status'] == 'mock':
-                        status_color = "🟡"
-                    else:
-                        status_color = "🔴"
-                    
-                    with st.expander(f"{status_color} Action {i}: {action_result['action']} sur {action_result['app']}", expanded=True):
-                        st.write(f"**Message:** {action_result['message']}")
-                        
-                        if action_result.get('details'):
-                            st.write("**Détails:**")
-                            st.json(action_result['details'])
+    with st.status("🔄 Traitement en cours...", expanded=True) as status:
+        for event in stream_api(user_query):
+            if event["event"] == "parsed":
+                result["parsed_tasks"] = event["parsed_tasks"]
+                n_tasks = len(event["parsed_tasks"].get("tasks", []))
+                st.write(f"🔧 {n_tasks} action(s) à exécuter")
+            elif event["event"] == "result":
+                # st.status est déjà un bloc dépliable : pas d'expander ici (affiché après)
+                action_result = event["result"]
+                result["results"].append(action_result)
+                st.write(
+                    f"{status_icon(action_result['status'])} Action {event['index'] + 1}: "
+                    f"{action_result['action']} - {action_result['message']}"
+                )
+            elif event["event"] == "done":
+                result["execution_time"] = event["execution_time"]
+                completed = True
+            elif event["event"] == "error":
+                st.error(f"❌ {event['detail']}")
             
-            with tab2:
-                st.subheader("JSON généré par le LLM")
-                st.json(result['parsed_tasks'])
+        status.update(
+            label="✅ Terminé" if completed else "❌ Échec",
+            state="complete" if completed else "error",
+            expanded=not completed
+        )
             
-            with tab3:
-                st.subheader("Réponse complète de l'API")
-                st.json(result)
+    if completed:
+        add_to_history(result)
+        render_run_result(result)
+    elif result["results"]:
+        # Échec en cours de route : les actions déjà exécutées restent visibles
+        st.subheader("Actions exécutées avant l'erreur")
+        for i, action_result in enumerate(result["results"], 1):
+            render_action_result(i, action_result)
 
 # Parser uniquement
 if parse_only_btn and user_query:
@@ -140,21 +292,35 @@ if parse_only_btn and user_query:
 if (execute_btn or parse_only_btn) and not user_query:
     st.warning("⚠️ Veuillez entrer une requête")
 
+# Réaffichage d'un résultat de l'historique, sans rappeler l'API
+if not (execute_btn or parse_only_btn) and st.session_state.get("history_selected") is not None:
+    selected = st.session_state["history_selected"]
+    if selected < len(st.session_state["history"]):
+        entry = st.session_state["history"][selected]
+        st.subheader(f"🕘 {entry['result']['query']}")
+        render_run_result(entry["result"])
+
 # Sidebar avec des exemples
 with st.sidebar:
+
+    st.header("🕘 Historique")
+
+    if st.session_state["history"]:
+        for i, entry in enumerate(st.session_state["history"]):
+            if st.button(f"{entry['timestamp']} - {entry['result']['query'][:40]}", key=f"history_{i}", use_container_width=True):
+                st.session_state["history_selected"] = i
+                st.rerun()
+    else:
+        st.caption("Aucune requête pour le moment")
     
     st.divider()
     
     st.header("⚙️ Configuration")
     
-    # Vérifier l'état de l'API
-    try:
-        health = requests.get(f"{API_URL}/health", timeout=2)
-        if health.status_code == 200:
-            st.success("✅ API connectée")
-        else:
-            st.error("❌ API non disponible")
-    except:
+    # Vérifier l'état de l'API (mis en cache quelques secondes)
+    if get_api_health():
+        st.success("✅ API connectée")
+    else:
         st.error("❌ API non disponible")
     
     st.info("""